@@ -1,7 +1,20 @@
 import os
 import re, math
+import errno, hashlib, shutil, tempfile, time, sys, struct, random
+import copy, threading, socket, socketserver, collections, unicodedata, array
+from concurrent.futures import ThreadPoolExecutor
 import bitstring
 
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 import taglib
 import musicbrainzngs
 import json
@@ -18,12 +31,43 @@ class blender():
 	fix_disc_number_of = False
 	fix_filenames = False
 	fix_foldernames = False
+	check_cover_art = False
+
+	# treat disc subfolders (CD1, Disc 2, ...) as part of one album
+	multi_disc = False
+	disc_folder_patterns = [r"^(?:cd|disc|disk)[ _.\-]*(\d+)\b"]
+
+	# cover art thresholds, None to disable
+	cover_min_dimension = 300
+	cover_max_dimension = 5000
+	cover_max_bytes = 10 * 1024 * 1024
+
+	# never write to the files being checked
+	read_only = False
 
 	# folders
 	current_folder = None
+	renamed_folder = None
 	move_to = None
+	copy_to = None
+	staging_dir = None
+	copy_workers = 4
+	io_order = None
+	io_stats = None
+	io_stats_lock = None
+	mp3info_cache = None
+	folder_index = None
+	tag_writer = None
 	tracks = None
+	disc_folders = None
 	tag_errors = None
+	collisions = None
+	check_failures = None
+	errors_tallied = 0
+	# errors caused by state outside the folder (the destination, failed copies, moves, renames and writes),
+	# which a rescan of the unchanged folder would not necessarily repeat
+	environment_errors = 0
+	telemetry = None
 
 	years_ok = False
 	subfolders_ok = False
@@ -42,6 +86,9 @@ class blender():
 
 	def __init__(self):
 		musicbrainzngs.set_useragent("music-blender", "0.1", "")
+		self.io_stats = new_seek_stats()
+		self.io_stats_lock = threading.Lock()
+		self.folder_index = FolderIndex()
 
 
 	def set_move_to(self, path):
@@ -50,6 +97,79 @@ class blender():
 			return
 		self.move_to = path
 
+	# check only: disables every fix, deletion, rename and move, and tag writes on open
+	def set_read_only(self):
+		self.read_only = True
+		for option in fix_options:
+			setattr(self, option, False)
+		self.move_to = None
+		self.copy_to = None
+
+	# unlike move-to, a missing destination is an error: carrying on would apply fixes to the source
+	def set_copy_to(self, path):
+		if not os.path.isdir(path):
+			raise ValueError("Copy-to destination folder {0} does not exist".format(path))
+		self.copy_to = path
+
+	# each pattern's first group must capture the disc number
+	def set_disc_folder_patterns(self, patterns):
+		for pattern in patterns:
+			try:
+				groups = re.compile(pattern).groups
+			except re.error as e:
+				raise ValueError("Invalid disc folder pattern {0}: {1}".format(pattern, e))
+			if groups < 1:
+				raise ValueError("Disc folder pattern {0} must capture the disc number in a group".format(pattern))
+		self.disc_folder_patterns = patterns
+
+	# the destination validated folders end up in, for either move or copy mode
+	def get_destination(self):
+		return self.move_to or self.copy_to
+
+	def get_staging_root(self):
+		return os.path.join(self.copy_to, ".music-blender-staging")
+
+	# copy a source folder into a private staging area next to the copy destination,
+	# so fixes are only ever applied to the copy
+	def stage_copy(self, path):
+		staging_root = self.get_staging_root()
+		while True:
+			os.makedirs(staging_root, exist_ok=True)
+			try:
+				self.staging_dir = tempfile.mkdtemp(dir=staging_root)
+				break
+			# another run removed the empty root in between
+			except FileNotFoundError:
+				continue
+
+		staged = os.path.join(self.staging_dir, os.path.basename(os.path.normpath(path)))
+		os.mkdir(staged)
+		copy_folder(path, staged, self.copy_workers)
+		return staged
+
+	# remove whatever is left of a staged copy (i.e. folders which failed validation)
+	def discard_staged_copy(self):
+		if not self.staging_dir:
+			return
+
+		if self.tracks:
+			for track in self.tracks:
+				track.close()
+
+		# the staging root is shared with other workers, see remove_staging_root
+		shutil.rmtree(self.staging_dir, ignore_errors=True)
+		self.folder_index.forget(self.staging_dir)
+		self.staging_dir = None
+
+	# remove the (empty) staging root once nothing else can be staging into it
+	def remove_staging_root(self):
+		if not self.copy_to:
+			return
+		try:
+			os.rmdir(self.get_staging_root())
+		except OSError:
+			pass
+
 	def open_folder(self, path):
 
 		self.years_ok = False
@@ -66,46 +186,183 @@ class blender():
 		self.filenames_ok = False
 		self.musicbrainz_ok = False
 
+		self.tracks = []
+		self.disc_folders = {}
+		self.renamed_folder = None
+		self.tag_errors = []
+		self.collisions = []
+		self.check_failures = {}
+		self.errors_tallied = 0
+		self.environment_errors = 0
+
+		# never leave the previous folder's state behind for validate_folder to act on
 		if not os.path.isdir(path):
-			print("Folder {0} does not exist".format(source))
+			self.current_folder = None
+			self.tag_errors.append("Folder {0} does not exist".format(path))
+			self.environment_errors += 1
 			return
+
+		if self.copy_to:
+			try:
+				path = self.stage_copy(path)
+			except OSError as e:
+				self.discard_staged_copy()
+				self.current_folder = None
+				self.tag_errors.append("Copy to destination failed: {0}".format(e))
+				self.environment_errors += 1
+				return
+
 		self.current_folder = path
+		self.tracks = self.load_tracks(self.current_folder)
 
-		self.tracks = []
-		self.tag_errors = []
-		items = os.listdir(self.current_folder)
+		if self.multi_disc:
+			self.disc_folders = self.find_disc_folders()
+
+			# load the discs concurrently
+			disc_names = sorted(self.disc_folders, key=lambda i: self.disc_folders[i])
+			if disc_names:
+				with ThreadPoolExecutor(max_workers=len(disc_names)) as pool:
+					discs = list(pool.map(self.load_tracks, [os.path.join(self.current_folder, i) for i in disc_names]))
+
+				for name, tracks in zip(disc_names, discs):
+					for track in tracks:
+						track.folder_disc = self.disc_folders[name]
+					self.tracks += tracks
+
+	# disc subfolders of the current folder, and the disc number in their name
+	def find_disc_folders(self):
+		disc_folders = {}
+
+		for i in os.listdir(self.current_folder):
+			if not os.path.isdir(os.path.join(self.current_folder, i)):
+				continue
+			for pattern in self.disc_folder_patterns:
+				match = re.search(pattern, i, re.IGNORECASE)
+				if not match:
+					continue
+				# a pattern's group may match something other than a number, i.e. disc a
+				try:
+					disc = int(match.group(1))
+				except (ValueError, TypeError):
+					continue
+				if disc > 0:
+					disc_folders[i] = disc
+					break
+
+		return disc_folders
+
+	# the album folder, and its disc subfolders, as (name relative to the album folder, path)
+	def get_album_folders(self):
+		folders = [("", self.current_folder)]
+		for i in sorted(self.disc_folders or {}, key=lambda i: self.disc_folders[i]):
+			folders.append((i, os.path.join(self.current_folder, i)))
+		return folders
 
+	def load_tracks(self, folder):
+		items = os.listdir(folder)
+
+		paths = []
 		for i in items:
-			if os.path.isdir(os.path.join(self.current_folder, i)):
+			if os.path.isdir(os.path.join(folder, i)):
+				continue
+
+			# skip temporary files left behind by an interrupted tag write
+			if i.startswith(tag_temp_prefix):
 				continue
 
 			if os.path.splitext(i)[-1].lower() == ".mp3":
-				path = os.path.join(self.current_folder, i)
+				paths.append(os.path.join(folder, i))
+
+		# open tracks in on-disk order, with their headers already being read ahead
+		# discs are loaded concurrently, so stats are merged in once the folder is ordered
+		if self.io_order:
+			stats = new_seek_stats()
+			paths = order_paths(paths, self.io_order, stats)
+			with self.io_stats_lock:
+				for key in stats:
+					self.io_stats[key] += stats[key]
+			for path in paths:
+				advise_readahead(path)
+
+		tracks = []
+		for path in paths:
+			# check for empty files
+			size = os.path.getsize(path)
+			if not size:
+				continue
+			
+			mp3info = None
+			if self.mp3info_cache is not None:
+				mp3info = self.mp3info_cache.get(path)
 
-				# check for empty files
-				if not os.path.getsize(path):
-					continue
-				
-				self.tracks.append(MusicFile(path))
+			tracks.append(MusicFile(path, self.telemetry, mp3info, self.read_only, self.tag_writer))
+
+			if self.telemetry:
+				self.telemetry.count(tracks=1, bytes_opened=size)
+
+		return tracks
 
 
 	def validate_folder(self):
 
+		# the folder could not be opened (or copied)
+		if self.current_folder is None:
+			self.tally_errors("open")
+			if self.telemetry:
+				self.telemetry.add_folder(self.check_failures)
+			return self.tag_errors
+
 		if len(self.tracks) == 0:
 			self.tag_errors.append("Folder contains no tracks")
+		self.tally_errors("tracks")
 
 		self.check_subfolders()
 		if not self.subfolders_ok:
 			self.tag_errors.append("Subfolder present")
+		self.tally_errors("subfolders")
 
 		disallowed_files = self.check_disallowed_files()
 		for file in disallowed_files:
 			self.tag_errors.append("Disallowed file: {0}".format(file))
+		self.tally_errors("disallowed_files")
+
+		if self.check_cover_art:
+			self.check_cover_images()
+			self.tally_errors("cover_art")
 
 		self.check_tags()
+		self.tally_errors("move")
+
+		self.wait_for_tag_writes()
+		self.tally_errors("tag_writes")
+
+		# anything still staged did not make it to the copy destination
+		self.discard_staged_copy()
+
+		if self.telemetry:
+			self.telemetry.add_folder(self.check_failures)
 
 		return self.tag_errors
 
+	# wait for queued tag writes of the given tracks (default: all of them) to reach the disk, reporting any failures
+	def wait_for_tag_writes(self, tracks=None):
+		if not self.tag_writer:
+			return True
+
+		failures = self.tag_writer.wait([i.path for i in (self.tracks if tracks is None else tracks)])
+		for path, error in failures:
+			self.tag_errors.append("{0}: could not write tags: {1}".format(os.path.basename(path), error))
+			self.environment_errors += 1
+
+		return len(failures) == 0
+
+	# attribute any errors added since the last call to the given check
+	def tally_errors(self, check):
+		count = len(self.tag_errors) - self.errors_tallied
+		if count:
+			self.check_failures[check] = self.check_failures.get(check, 0) + count
+		self.errors_tallied = len(self.tag_errors)
+
 	def check_tags(self, subfolder_mode=False):
 
 		if not len(self.tracks):
@@ -113,42 +370,77 @@ class blender():
 
 		# disc numbers before track numbers
 		disc_numbers = self.check_disc_numbers()
+		self.tally_errors("disc_numbers")
 
 		if not subfolder_mode:
 			self.check_disc_number_of(disc_numbers)
+			self.tally_errors("disc_number_of")
 				
 		self.check_album_titles()
+		self.tally_errors("album_titles")
 		self.check_track_titles()
+		self.tally_errors("track_titles")
 		self.check_artists()
+		self.tally_errors("artists")
 		self.check_album_artists()
+		self.tally_errors("album_artists")
 		self.check_years()
+		self.tally_errors("years")
 		self.musicbrainz_verify()
+		self.tally_errors("musicbrainz")
 
 		all_tracks_present = self.check_track_numbers()
+		self.tally_errors("track_numbers")
 		self.check_track_number_of(all_tracks_present)
+		self.tally_errors("track_number_of")
 
 
 
 		self.check_filenames()
+		self.tally_errors("filenames")
 		bitrate = self.get_overall_bitrate()
 		
 
 		if self.album_artist_ok == False or self.artists_ok == False or self.album_title_ok == False:
 			self.tag_errors.append("Folder name validation impossible")
+			self.tally_errors("foldernames")
 			return self.tag_errors
 
 		# must be done last
 		correct_folder_name = self.get_correct_folder_name(bitrate)
+		self.tally_errors("foldernames")
 
-		# update the current folder name
-		self.current_folder = os.path.join(os.path.dirname(self.current_folder), correct_folder_name)
+		# follow the folder if it was renamed
+		if self.renamed_folder:
+			self.current_folder = self.renamed_folder
 
 		# move to the output folder if required
-		if len(self.tag_errors) == 0 and self.move_to and not os.path.exists(os.path.join(self.move_to, correct_folder_name)):
+		destination = self.get_destination()
+		if destination:
+			self.wait_for_tag_writes()
+
+		if len(self.tag_errors) == 0 and destination:
+			destination_path = os.path.join(destination, correct_folder_name)
+
+			# the index can be stale, so an exact match is also checked on disk
+			if os.path.lexists(destination_path):
+				self.folder_index.add(destination, correct_folder_name)
+			if self.report_collisions(destination, correct_folder_name):
+				return self.tag_errors
 
 			for track in self.tracks:
 					track.close()
-			os.rename(self.current_folder, os.path.join(self.move_to, correct_folder_name))
+			try:
+				move_folder(self.current_folder, destination_path, self.copy_workers)
+			except FileExistsError:
+				self.folder_index.add(destination, correct_folder_name)
+				self.report_collisions(destination, correct_folder_name)
+			except OSError as e:
+				self.tag_errors.append("Could not move folder to {0}: {1}".format(destination_path, e))
+				self.environment_errors += 1
+			else:
+				self.folder_index.remove(os.path.dirname(self.current_folder), correct_folder_name)
+				self.folder_index.add(destination, correct_folder_name)
 
 		return self.tag_errors
 
@@ -198,39 +490,102 @@ class blender():
 		items = os.listdir(self.current_folder)
 
 		for i in items:
-			if os.path.isdir(os.path.join(self.current_folder, i)):
+			if os.path.isdir(os.path.join(self.current_folder, i)) and i not in self.disc_folders:
 				self.subfolders_ok = False
 				return
 		self.subfolders_ok = True
 
 	# check for non-whitelisted file types
 	def check_disallowed_files(self):
-		items = os.listdir(self.current_folder)
-
 		disallowed_files = []
+		writes_finished = False
 
-		for i in items:
+		for name, folder in self.get_album_folders():
+			for i in os.listdir(folder):
 
-			# skip folders
-			if os.path.isdir(os.path.join(self.current_folder, i)):
-				continue
-			if i == ".mix":
-				continue
-			ext = os.path.splitext(i)[-1].lower()
-			if ext not in allowed_extensions:
+				# skip folders
+				if os.path.isdir(os.path.join(folder, i)):
+					continue
+				if i == ".mix":
+					continue
 
-				# delete the file if appropriate
-				if self.delete_disallowed_files:
-					os.remove(os.path.join(self.current_folder, i))
-				# otherwise, add to failure reasons
-				else:
-					disallowed_files.append(i)
+				# left behind by an interrupted tag write, once this run's own writes have finished
+				if i.startswith(tag_temp_prefix):
+					if not writes_finished:
+						self.wait_for_tag_writes()
+						writes_finished = True
+					if not os.path.exists(os.path.join(folder, i)):
+						continue
+
+					if self.delete_disallowed_files:
+						os.remove(os.path.join(folder, i))
+					else:
+						disallowed_files.append("{0} (left by an interrupted tag write)".format(os.path.join(name, i)))
+					continue
+
+				ext = os.path.splitext(i)[-1].lower()
+				if ext not in allowed_extensions:
+
+					# delete the file if appropriate
+					if self.delete_disallowed_files:
+						os.remove(os.path.join(folder, i))
+					# otherwise, add to failure reasons
+					else:
+						disallowed_files.append(os.path.join(name, i))
 
 		if len(disallowed_files) == 0:
 			self.disallowed_files_ok = True
 
 		return disallowed_files
 
+	# check image files and embedded (APIC) album art are intact and sensibly sized, reading only their headers
+	def check_cover_images(self):
+		images = []
+		for name, folder in self.get_album_folders():
+			for i in sorted(os.listdir(folder)):
+				if os.path.splitext(i)[-1].lower() in image_extensions:
+					images.append((os.path.join(name, i), os.path.join(folder, i)))
+
+		for i, path in images:
+			if not os.path.isfile(path):
+				continue
+			try:
+				with open(path, "rb") as f:
+					image = read_image_header(f, 0, os.fstat(f.fileno()).st_size)
+			except OSError as e:
+				self.tag_errors.append("Cover art {0} could not be read: {1}".format(i, e))
+				continue
+
+			if image["format"] and image["format"] != image_extensions[os.path.splitext(i)[-1].lower()]:
+				self.tag_errors.append("Cover art {0} is a {1} image".format(i, image["format"].upper()))
+			self.report_cover_image("Cover art {0}".format(i), image)
+
+		for track in self.tracks:
+			try:
+				images = read_embedded_images(track.path)
+			except OSError as e:
+				self.tag_errors.append("{0}: embedded cover art could not be read: {1}".format(track.get_filename(), e))
+				continue
+
+			for image in images:
+				self.report_cover_image("{0}: embedded cover art".format(track.get_filename()), image)
+
+	def report_cover_image(self, name, image):
+		if image["error"]:
+			self.tag_errors.append("{0} is corrupt: {1}".format(name, image["error"]))
+			return
+		if image["truncated"]:
+			self.tag_errors.append("{0} is truncated".format(name))
+
+		smallest = min(image["width"], image["height"])
+		largest = max(image["width"], image["height"])
+		if self.cover_min_dimension and smallest < self.cover_min_dimension:
+			self.tag_errors.append("{0} is too small ({1}x{2}, minimum {3})".format(name, image["width"], image["height"], self.cover_min_dimension))
+		if self.cover_max_dimension and largest > self.cover_max_dimension:
+			self.tag_errors.append("{0} is too large ({1}x{2}, maximum {3})".format(name, image["width"], image["height"], self.cover_max_dimension))
+		if self.cover_max_bytes and image["size"] > self.cover_max_bytes:
+			self.tag_errors.append("{0} is too large ({1} bytes, maximum {2})".format(name, image["size"], self.cover_max_bytes))
+
 	# check the folder havs a full set of strictly incrementing tracks, starting at 1
 	def check_track_numbers(self):
 
@@ -239,7 +594,7 @@ class blender():
 		for track in self.tracks:
 			track_num = None
 
-			disc_num = int(track.get_tag('DISCNUMBER').split("/")[0]) or 1
+			disc_num = self.get_disc_number(track)
 			if not track_numbers.get(disc_num):
 					track_numbers[disc_num] = []
 
@@ -272,10 +627,11 @@ class blender():
 				all_tracks_present = False
 				break
 
-			if track_numbers[disc][0] != 1:
+			# discs are loaded in listing order, so the tracks may be in any order
+			curr_track_numbers = sorted(track_numbers[disc])
+			if curr_track_numbers[0] != 1:
 				all_tracks_present = False
 
-			curr_track_numbers = sorted(track_numbers[disc])
 			for i in range(0, len(curr_track_numbers)-1):
 				if curr_track_numbers[i] != curr_track_numbers[i+1]-1:
 					all_tracks_present = False
@@ -283,7 +639,7 @@ class blender():
 		if not all_tracks_present:
 			flattened_track_nums = ""
 			for disc in track_numbers:
-				flattened_track_nums += " Disc " + str(disc) + ": " + ",".join(str(i) for i in track_numbers[disc])
+				flattened_track_nums += " Disc " + str(disc) + ": " + ",".join(str(i) for i in sorted(track_numbers[disc]))
 			self.tag_errors.append("Directory does not have a full set of tracks:{0}".format(flattened_track_nums))
 
 
@@ -322,6 +678,9 @@ class blender():
 	# check we have a full set of strictly incrementing tracks, starting at 1
 	def check_disc_numbers(self):
 
+		if self.disc_folders:
+			return self.check_folder_disc_numbers()
+
 		self.disc_numbers_ok = True
 		# check track numbers
 		disc_numbers = []
@@ -364,6 +723,57 @@ class blender():
 
 		return disc_numbers
 
+	# disc number of a track, from its disc subfolder if it has one, otherwise from its tag (default 1)
+	def get_disc_number(self, track):
+		if track.folder_disc is not None:
+			return track.folder_disc
+		try:
+			return int(track.get_tag('DISCNUMBER').split("/")[0]) or 1
+		except (AttributeError, ValueError):
+			return 1
+
+	# multi-disc albums: the disc subfolders must be numbered 1 to n, every track must be in one,
+	# and each track's disc number must match the disc subfolder it is in
+	def check_folder_disc_numbers(self):
+
+		self.disc_numbers_ok = True
+		disc_numbers = sorted(set(self.disc_folders.values()))
+
+		missing = [str(i) for i in range(1, disc_numbers[-1] + 1) if i not in disc_numbers]
+		if missing:
+			self.tag_errors.append("Missing disc folders: disc {0} of {1}".format(", ".join(missing), disc_numbers[-1]))
+			self.disc_numbers_ok = False
+
+		for disc in disc_numbers:
+			names = sorted(i for i in self.disc_folders if self.disc_folders[i] == disc)
+			if len(names) > 1:
+				self.tag_errors.append("Disc {0} has more than one folder: {1}".format(disc, ", ".join(names)))
+				self.disc_numbers_ok = False
+
+		outside = sorted(i.get_filename() for i in self.tracks if i.folder_disc is None)
+		if outside:
+			self.tag_errors.append("Tracks outside disc subfolders: {0}".format(", ".join(outside)))
+			self.disc_numbers_ok = False
+
+		for track in self.tracks:
+			if track.folder_disc is None:
+				continue
+
+			disc_num_split = (track.get_tag('DISCNUMBER') or "").split("/")
+			try:
+				disc_num = int(disc_num_split[0])
+			except ValueError:
+				disc_num = None
+
+			if disc_num != track.folder_disc:
+				if self.fix_disc_numbers:
+					track.write_tag('DISCNUMBER', ["{0}/{1}".format(track.folder_disc, disc_numbers[-1])])
+				else:
+					self.tag_errors.append("{0}: disc number should be {1}".format(track.get_filename(), track.folder_disc))
+					self.disc_numbers_ok = False
+
+		return disc_numbers
+
 	# check the disc number-of field
 	def check_disc_number_of(self, disc_numbers):
 
@@ -388,6 +798,14 @@ class blender():
 					self.disc_number_of_ok = True
 				continue
 
+			# a lone disc may belong to a larger set, but a merged multi-disc album is the whole set
+			if self.disc_folders and len(disc_numbers) != 0 and disc_num_split[1] != str(disc_numbers[-1]):
+				if self.fix_disc_number_of:
+					track.write_tag('DISCNUMBER', ["{0}/{1}".format(disc_num_split[0], disc_numbers[-1])])
+				else:
+					self.tag_errors.append("{0}: disc number-of incorrect: {1} should be {2}".format(track.get_filename(), disc_num_split[1], disc_numbers[-1]))
+					self.disc_number_of_ok = False
+
 	# check all tracks have (correct) titles
 	def check_track_titles(self):
 
@@ -472,8 +890,9 @@ class blender():
 				return
 
 			# if a multi disc album, prepend the disc number to the track number in the filename
-			if track.get_tag('DISCNUMBER') and track.get_tag('DISCNUMBER').split("/")[1] != "1":
-				disc_num = track.get_tag('DISCNUMBER').split("/")[0]
+			disc_num_split = (track.get_tag('DISCNUMBER') or "").split("/")
+			if len(disc_num_split) > 1 and disc_num_split[1] != "1":
+				disc_num = disc_num_split[0]
 			else:
 				disc_num = ""
 
@@ -485,6 +904,7 @@ class blender():
 			
 			if track.get_filename() != correct_filename:
 				if self.fix_filenames:
+					self.wait_for_tag_writes([track])
 					track.close()
 					try:
 						new_path = os.path.join(os.path.dirname(track.path), correct_filename)
@@ -493,7 +913,8 @@ class blender():
 							new_path = new_path[0:259-len(ext)] + ext
 
 						os.rename(track.path, new_path)
-						new_track = MusicFile(new_path)
+						# renaming leaves the audio stream untouched
+						new_track = MusicFile(new_path, self.telemetry, track.mp3info, self.read_only, self.tag_writer)
 					except FileExistsError:
 						self.tag_errors.append("Duplicate filename: {0}".format(correct_filename))
 						self.filenames_ok = False
@@ -512,38 +933,9 @@ class blender():
 		vbr_accumulator = 0
 
 		for track in self.tracks:
-			curr_track_bitrate = None
+			curr_track_bitrate = get_track_bitrate(track)
 
-			if track.mp3info.lame_version:
-
-				if track.mp3info.lame_vbr_method in [1,8]:
-					curr_track_bitrate = "CBR{0}".format(track.bitrate)
-
-				elif track.mp3info.lame_vbr_method == 3:
-					if track.mp3info.xing_vbr_v == 0:
-						curr_track_bitrate = "APE"
-					elif track.mp3info.xing_vbr_v == 1:
-						curr_track_bitrate = "APM"
-					elif track.mp3info.xing_vbr_v == 2:
-						curr_track_bitrate = "APS"
-					else:
-						curr_track_bitrate = "vbr-old V{0}".format(track.mp3info.xing_vbr_v)
-						#raise ValueError("I don't know what kind of --vbr-old this is ({0})".format(track.mp3info.xing_vbr_v))
-
-				elif track.mp3info.lame_vbr_method in [4,5]:
-					curr_track_bitrate = "V{0}".format(track.mp3info.xing_vbr_v)
-				elif track.mp3info.lame_vbr_method in [2,9]:
-					curr_track_bitrate = "ABR"
-					vbr_accumulator += track.bitrate
-				else:
-					curr_track_bitrate = "lame_vbr_method {0}".format(track.mp3info.lame_vbr_method)
-					#raise ValueError("I don't know what kind of lame_vbr_method this is ({0})".format(track.mp3info.lame_vbr_method))
-			
-			elif track.mp3info.method == "CBR":
-				curr_track_bitrate = "CBR{0}".format(track.bitrate)
-
-			elif track.mp3info.method == "VBR":
-				curr_track_bitrate = "VBR"
+			if curr_track_bitrate in ["VBR", "ABR"]:
 				vbr_accumulator += track.bitrate
 
 
@@ -586,23 +978,54 @@ class blender():
 		
 		if current_folder_name != correct_folder_name:
 			if self.fix_foldernames:
+				self.wait_for_tag_writes()
 				for track in self.tracks:
 					track.close()
 
 				path_curr = os.path.join(current_folder_parent, current_folder_name)
 				path_correct = os.path.join(current_folder_parent, correct_folder_name)
 
-				# if the path doesn't exist, or we are renaming in a case-insensitive OS
-				if not os.path.exists(path_correct) or path_curr.lower() == path_correct.lower():
-					os.rename(path_curr, path_correct)
-				else:
-					self.tag_errors.append("Destination folder {0} already exists".format(path_correct))
+				# the folder itself may only differ in case, which is fine to rename on a case-insensitive OS
+				if not self.report_collisions(current_folder_parent, correct_folder_name, current_folder_name):
+					# the index can be stale (i.e. in the daemon), so only a case-only rename of the folder
+					# itself may land on an existing path; anything else goes through move_folder
+					try:
+						if os.path.lexists(path_correct) and os.path.samefile(path_curr, path_correct):
+							os.rename(path_curr, path_correct)
+						else:
+							move_folder(path_curr, path_correct, self.copy_workers)
+					except OSError as e:
+						if os.path.lexists(path_correct):
+							self.folder_index.add(current_folder_parent, correct_folder_name)
+							self.report_collisions(current_folder_parent, correct_folder_name, current_folder_name)
+						else:
+							self.tag_errors.append("Could not rename folder to {0}: {1}".format(path_correct, e))
+							self.environment_errors += 1
+					else:
+						self.renamed_folder = path_correct
+						self.folder_index.remove(current_folder_parent, current_folder_name)
+						self.folder_index.add(current_folder_parent, correct_folder_name)
 
 			else:
 				self.tag_errors.append("Folder name should be {0}, not {1}".format(correct_folder_name, current_folder_name))
 
 		return correct_folder_name
 
+	# add an error for every folder in the directory which the given name would clash with
+	def report_collisions(self, directory, name, ignore=None):
+		collisions = self.folder_index.find_collisions(directory, name, ignore)
+
+		for collision in collisions:
+			self.collisions.append(collision)
+			self.environment_errors += 1
+			if collision["kind"] == "exact":
+				self.tag_errors.append("Destination folder {0} already exists".format(collision["path"]))
+			else:
+				self.tag_errors.append("Destination folder {0} collides with existing {1} (differs only in {2})".format(
+					os.path.join(directory, name), collision["path"], collision["kind"]))
+
+		return len(collisions) != 0
+
 	def musicbrainz_verify(self):
 		return
 		if not self.album_artist_ok or not self.album_title_ok:
@@ -717,13 +1140,23 @@ class MusicFile():
 	metadata = None
 	bitrate = None
 	mp3info = None
+	telemetry = None
+	read_only = False
+	tag_writer = None
+	closed = False
+
+	# disc number implied by the disc subfolder the track is in
+	folder_disc = None
 
 	def get_filename(self):
 		return self.path.split(os.path.sep)[-1]
 
-	def __init__(self, path):
+	def __init__(self, path, telemetry=None, mp3info=None, read_only=False, tag_writer=None):
 		self.path = path
-		self.mp3info =  Mp3Info(path)
+		self.telemetry = telemetry
+		self.read_only = read_only
+		self.tag_writer = tag_writer
+		self.mp3info = mp3info or Mp3Info(path)
 		self.metadata = taglib.File(path)
 		self.bitrate = self.metadata.bitrate
 		self.initial_clean()
@@ -739,7 +1172,7 @@ class MusicFile():
 					write = True
 
 		if write:
-			self.metadata.save()
+			self.save()
 
 
 	def get_tag (self, tag, full=False):
@@ -759,6 +1192,19 @@ class MusicFile():
 
 	def write_tag(self, tag, value):
 		self.metadata.tags[tag] = value
+		self.save()
+
+	# write the in-memory tags out, via the background writer if there is one
+	def save(self):
+		if self.read_only:
+			return
+		if self.telemetry:
+			self.telemetry.count(tag_saves=1)
+
+		if self.tag_writer:
+			self.tag_writer.submit(self.path, self.metadata.tags)
+			return
+
 		retval = self.metadata.save()
 		if len(retval) != 0:
 			print("Could not alter track tag: {0}".format(self.metadata))
@@ -816,8 +1262,12 @@ class MusicFile():
 			self.write_tag(tag, new_tag_val)
 
 
+	# safe to call more than once, as renames and moves each close the tracks first
 	def close(self):
+		if self.closed:
+			return
 		self.metadata.close()
+		self.closed = True
 
 
 	def __repr__(self):
@@ -827,6 +1277,51 @@ class MusicFile():
 	def __gt__(self, other):
 		return self.get_filename() > other.get_filename()
 
+# bitrate class of a single track, e.g. CBR320, V0, APS, VBR
+def get_track_bitrate(track):
+	curr_track_bitrate = None
+
+	if track.mp3info.lame_version:
+
+		if track.mp3info.lame_vbr_method in [1,8]:
+			curr_track_bitrate = "CBR{0}".format(track.bitrate)
+
+		elif track.mp3info.lame_vbr_method == 3:
+			if track.mp3info.xing_vbr_v == 0:
+				curr_track_bitrate = "APE"
+			elif track.mp3info.xing_vbr_v == 1:
+				curr_track_bitrate = "APM"
+			elif track.mp3info.xing_vbr_v == 2:
+				curr_track_bitrate = "APS"
+			else:
+				curr_track_bitrate = "vbr-old V{0}".format(track.mp3info.xing_vbr_v)
+				#raise ValueError("I don't know what kind of --vbr-old this is ({0})".format(track.mp3info.xing_vbr_v))
+
+		elif track.mp3info.lame_vbr_method in [4,5]:
+			curr_track_bitrate = "V{0}".format(track.mp3info.xing_vbr_v)
+		elif track.mp3info.lame_vbr_method in [2,9]:
+			curr_track_bitrate = "ABR"
+		else:
+			curr_track_bitrate = "lame_vbr_method {0}".format(track.mp3info.lame_vbr_method)
+			#raise ValueError("I don't know what kind of lame_vbr_method this is ({0})".format(track.mp3info.lame_vbr_method))
+	
+	elif track.mp3info.method == "CBR":
+		curr_track_bitrate = "CBR{0}".format(track.bitrate)
+
+	elif track.mp3info.method == "VBR":
+		curr_track_bitrate = "VBR"
+
+	return curr_track_bitrate
+
+# prefix of the temporary files tag writes go through
+tag_temp_prefix = ".music-blender-tags-"
+
+# the blender settings which modify files, switched off for validate-only requests
+fix_options = ["delete_disallowed_files", "fix_track_numbers", "fix_track_number_of", "fix_disc_numbers", "fix_disc_number_of",
+		"fix_album_artist", "fix_year", "fix_filenames", "fix_foldernames"]
+
+image_extensions = {".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png"}
+
 allowed_extensions = [".mp3", ".flac", ".jpg", ".jpeg", ".png", ".log", ".mix"]
 
 def clean_text(text):
@@ -842,3 +1337,1538 @@ def nt_path_fix(path):
 
 	return path
 
+# ioctl request number for reflink clones on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# share extents with the source file when the filesystem supports it
+def reflink_file(fsrc, fdst):
+	if fcntl is None:
+		return False
+	try:
+		fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+		return True
+	except OSError:
+		return False
+
+# copy file contents in the kernel, falling back to sendfile and finally a userspace copy
+def copy_file_data(fsrc, fdst, size):
+	copied = 0
+
+	if hasattr(os, "copy_file_range"):
+		try:
+			while copied < size:
+				count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied, copied, copied)
+				if count == 0:
+					break
+				copied += count
+		except OSError as e:
+			if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+				raise
+
+	if copied < size and hasattr(os, "sendfile"):
+		fdst.seek(copied)
+		try:
+			while copied < size:
+				count = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+				if count == 0:
+					break
+				copied += count
+		except OSError as e:
+			if copied or e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+				raise
+
+	if copied < size:
+		fsrc.seek(copied)
+		fdst.seek(copied)
+		shutil.copyfileobj(fsrc, fdst)
+
+def file_digest(path):
+	digest = hashlib.blake2b()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1 << 20), b""):
+			digest.update(chunk)
+	return digest.digest()
+
+def copy_file_verified(src, dst):
+	with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+		if not reflink_file(fsrc, fdst):
+			copy_file_data(fsrc, fdst, os.fstat(fsrc.fileno()).st_size)
+	shutil.copystat(src, dst)
+
+	if os.path.getsize(src) != os.path.getsize(dst) or file_digest(src) != file_digest(dst):
+		raise OSError(errno.EIO, "Copy verification failed", dst)
+
+# copy a folder tree, copying the files within it in parallel
+# copy the contents of src into dst, which the caller has already created
+def copy_folder(src, dst, workers=4):
+
+	files = []
+	for root, subfolders, names in os.walk(src):
+		out_root = os.path.join(dst, os.path.relpath(root, src))
+		for i in subfolders:
+			os.makedirs(os.path.join(out_root, i), exist_ok=True)
+		for i in names:
+			files.append((os.path.join(root, i), os.path.join(out_root, i)))
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		for future in [pool.submit(copy_file_verified, *i) for i in files]:
+			future.result()
+
+	shutil.copystat(src, dst)
+
+# rename a folder, falling back to copy-and-delete across filesystems; never lands on an existing path
+def move_folder(src, dst, workers=4):
+	# os.rename replaces an empty folder on POSIX, so claim dst first (mkdir fails if it exists)
+	# and only ever replace that placeholder; renames on Windows never replace anything
+	if os.name != "nt":
+		os.mkdir(dst)
+
+	try:
+		os.rename(src, dst)
+	except OSError as e:
+		if os.name != "nt":
+			try:
+				os.rmdir(dst)
+			except OSError:
+				pass
+		if e.errno != errno.EXDEV:
+			raise
+		# never clean up a destination that was already there
+		os.mkdir(dst)
+		try:
+			copy_folder(src, dst, workers)
+		except OSError:
+			shutil.rmtree(dst, ignore_errors=True)
+			raise
+		shutil.rmtree(src)
+
+
+# append-only record of finished folders, so an interrupted scan can be resumed
+class Checkpoint():
+	path = None
+	source = None
+	records = None
+
+	def __init__(self, path, source, resume=False):
+		self.path = path
+		self.source = os.path.abspath(source)
+		self.records = {}
+
+		if resume and os.path.exists(path):
+			self.load()
+		else:
+			with open(path, "w") as f:
+				f.write(json.dumps({"source": self.source}) + "\n")
+				f.flush()
+				os.fsync(f.fileno())
+
+	def load(self):
+		with open(self.path, encoding="utf-8") as f:
+			lines = f.readlines()
+
+		# terminate a torn last line, so the next append starts on a line of its own
+		if lines and not lines[-1].endswith("\n"):
+			with open(self.path, "a") as f:
+				f.write("\n")
+
+		for line in lines:
+			# a torn last line means the scan was killed mid-append
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+
+			if "source" in record:
+				if record["source"] != self.source:
+					raise ValueError("Checkpoint {0} belongs to {1}, not {2}".format(self.path, record["source"], self.source))
+				continue
+
+			self.records[record["folder"]] = record
+
+	# a folder only counts as done if it has not been modified since it was checkpointed
+	def is_done(self, folder):
+		record = self.records.get(folder)
+		if record is None:
+			return False
+		return record["mtime"] == get_mtime(os.path.join(self.source, folder))
+
+	# cached results for folders which are no longer present in the source (i.e. moved away)
+	def get_departed(self, present):
+		return [i for i in self.records.values() if i["folder"] not in present]
+
+	def add(self, folder, name, failure_reasons):
+		record = {
+			"folder": folder,
+			"name": name,
+			"mtime": get_mtime(os.path.join(self.source, folder)),
+			"failure_reasons": failure_reasons,
+		}
+		self.records[folder] = record
+
+		# a single O_APPEND write per record, so concurrent readers never see a partial line
+		line = (json.dumps(record) + "\n").encode("utf-8")
+		fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+		try:
+			os.write(fd, line)
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+def get_mtime(path):
+	try:
+		return os.stat(path).st_mtime_ns
+	except OSError:
+		return None
+
+# throughput counters for a scan, shown as a progress line and exported for node-exporter
+class Telemetry():
+	total_folders = 0
+	folders = 0
+	skipped_folders = 0
+	tracks = 0
+	# size of the track files opened, not the bytes actually read from disk
+	bytes_opened = 0
+	tag_saves = 0
+	errors = None
+	lock = None
+
+	textfile = None
+	textfile_interval = 15
+	display = False
+	display_interval = 0.5
+
+	started = None
+	last_display = 0
+	last_textfile = 0
+	displayed = False
+
+	def __init__(self, total_folders=0, textfile=None, display=False):
+		self.total_folders = total_folders
+		self.textfile = textfile
+		self.display = display
+		self.errors = {}
+		self.lock = threading.Lock()
+		self.started = time.monotonic()
+
+	# counters updated while tracks are loading, which may be on several threads at once
+	def count(self, tracks=0, bytes_opened=0, tag_saves=0):
+		with self.lock:
+			self.tracks += tracks
+			self.bytes_opened += bytes_opened
+			self.tag_saves += tag_saves
+
+	def add_folder(self, check_failures):
+		self.folders += 1
+		for check in check_failures:
+			self.errors[check] = self.errors.get(check, 0) + check_failures[check]
+
+	# folders which were not scanned this run (e.g. checkpointed), for the ETA
+	def skip_folder(self):
+		self.skipped_folders += 1
+
+	def get_elapsed(self):
+		return max(time.monotonic() - self.started, 1e-6)
+
+	def get_eta(self):
+		if not self.folders:
+			return None
+		remaining = max(self.total_folders - self.folders - self.skipped_folders, 0)
+		return remaining * self.get_elapsed() / self.folders
+
+	def get_progress_line(self):
+		elapsed = self.get_elapsed()
+		eta = self.get_eta()
+
+		return "{0}/{1} folders  {2:.1f} folders/s  {3:.1f} tracks/s  {4:.1f} MB/s opened  {5:.1f} saves/s  {6} errors  ETA {7}".format(
+			self.folders + self.skipped_folders, self.total_folders,
+			self.folders / elapsed, self.tracks / elapsed, self.bytes_opened / elapsed / 1e6, self.tag_saves / elapsed,
+			sum(self.errors.values()), format_duration(eta) if eta is not None else "?")
+
+	# called between folders; does nothing until one of the intervals has elapsed
+	def report(self, force=False):
+		now = time.monotonic()
+
+		if self.display and (force or now - self.last_display >= self.display_interval):
+			sys.stderr.write("\r" + self.get_progress_line() + "\033[K")
+			sys.stderr.flush()
+			self.last_display = now
+			self.displayed = True
+
+		if self.textfile and (force or now - self.last_textfile >= self.textfile_interval):
+			self.write_textfile()
+			self.last_textfile = now
+
+	# clear the progress line before printing anything else to the terminal
+	def clear(self):
+		if self.displayed:
+			sys.stderr.write("\r\033[K")
+			sys.stderr.flush()
+			self.displayed = False
+
+	def write_textfile(self):
+		elapsed = self.get_elapsed()
+		eta = self.get_eta()
+
+		metrics = [
+			("folders_total", "counter", "Album folders validated", self.folders),
+			("folders_skipped_total", "counter", "Album folders skipped as already checkpointed", self.skipped_folders),
+			("folders_expected", "gauge", "Album folders in the source", self.total_folders),
+			("tracks_total", "counter", "Tracks opened", self.tracks),
+			("opened_bytes_total", "counter", "Size of the track files opened", self.bytes_opened),
+			("tag_saves_total", "counter", "Tag writes", self.tag_saves),
+			("folders_per_second", "gauge", "Average folder throughput", self.folders / elapsed),
+			("tracks_per_second", "gauge", "Average track throughput", self.tracks / elapsed),
+			("opened_bytes_per_second", "gauge", "Size of the track files opened per second", self.bytes_opened / elapsed),
+			("tag_saves_per_second", "gauge", "Average tag write throughput", self.tag_saves / elapsed),
+			("eta_seconds", "gauge", "Estimated time to completion", eta if eta is not None else float("nan")),
+		]
+
+		lines = []
+		for name, kind, description, value in metrics:
+			lines.append("# HELP music_blender_{0} {1}".format(name, description))
+			lines.append("# TYPE music_blender_{0} {1}".format(name, kind))
+			lines.append("music_blender_{0} {1}".format(name, value))
+
+		lines.append("# HELP music_blender_check_errors_total Validation errors by check")
+		lines.append("# TYPE music_blender_check_errors_total counter")
+		for check in sorted(self.errors):
+			lines.append("music_blender_check_errors_total{{check=\"{0}\"}} {1}".format(check, self.errors[check]))
+
+		# node-exporter may read at any time, so replace the file atomically
+		tmp_path = "{0}.{1}.tmp".format(self.textfile, os.getpid())
+		with open(tmp_path, "w") as f:
+			f.write("\n".join(lines) + "\n")
+		os.replace(tmp_path, self.textfile)
+
+def format_duration(seconds):
+	seconds = int(seconds)
+	return "{0}:{1:02d}:{2:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+# ioctl request number for extent maps on Linux
+FS_IOC_FIEMAP = 0xC020660B
+
+# the part of a track read by Mp3Info and taglib when opening it
+HEADER_READAHEAD = 256 * 1024
+TAIL_READAHEAD = 4096
+
+IO_ORDERS = ["inode", "extent"]
+
+# physical byte offset of the first extent of a file or folder, or None if unavailable
+def get_physical_offset(path):
+	if fcntl is None:
+		return None
+
+	# struct fiemap asking for a single struct fiemap_extent
+	request = struct.pack("=QQLLLL", 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(56)
+	try:
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			result = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+		finally:
+			os.close(fd)
+	except OSError:
+		return None
+
+	if not struct.unpack_from("=L", result, 20)[0]:
+		return None
+	return struct.unpack_from("=Q", result, 40)[0]
+
+def get_disk_positions(paths, mode):
+	if mode == "extent":
+		positions = [get_physical_offset(i) for i in paths]
+		# offsets and inode numbers don't mix, so only use extents if every path has one
+		if None not in positions:
+			return positions
+
+	positions = []
+	for i in paths:
+		try:
+			positions.append(os.stat(i).st_ino)
+		except OSError:
+			positions.append(0)
+	return positions
+
+def new_seek_stats():
+	return {"items": 0, "distance_unordered": 0, "distance_ordered": 0, "backward_unordered": 0, "backward_ordered": 0}
+
+# head travel (in disk position units) and backward jumps when visiting positions in sequence
+def get_seek_distance(positions):
+	distance = 0
+	backward = 0
+	for i in range(1, len(positions)):
+		distance += abs(positions[i] - positions[i-1])
+		if positions[i] < positions[i-1]:
+			backward += 1
+	return distance, backward
+
+# sort paths by their position on disk, accumulating before/after seek stats
+def order_paths(paths, mode, stats=None):
+	positions = get_disk_positions(paths, mode)
+	ordered = sorted(zip(positions, paths))
+
+	if stats is not None:
+		distance, backward = get_seek_distance(positions)
+		stats["items"] += len(paths)
+		stats["distance_unordered"] += distance
+		stats["backward_unordered"] += backward
+		distance, backward = get_seek_distance([i[0] for i in ordered])
+		stats["distance_ordered"] += distance
+		stats["backward_ordered"] += backward
+
+	return [i[1] for i in ordered]
+
+def format_seek_stats(stats):
+	reduction = 0
+	if stats["distance_unordered"]:
+		reduction = 100 * (1 - stats["distance_ordered"] / stats["distance_unordered"])
+	return "{0} items, seek distance reduced by {1:.1f}%, backward seeks {2} -> {3}".format(
+		stats["items"], reduction, stats["backward_unordered"], stats["backward_ordered"])
+
+# start reading the header and tail of a track into the page cache
+def advise_readahead(path, sequential=False, fd=None):
+	if not hasattr(os, "posix_fadvise"):
+		return
+
+	close = fd is None
+	try:
+		if close:
+			fd = os.open(path, os.O_RDONLY)
+		try:
+			size = os.fstat(fd).st_size
+			# only affects reads through this descriptor
+			if sequential:
+				os.posix_fadvise(fd, 0, HEADER_READAHEAD, os.POSIX_FADV_SEQUENTIAL)
+			os.posix_fadvise(fd, 0, HEADER_READAHEAD, os.POSIX_FADV_WILLNEED)
+			if size > HEADER_READAHEAD:
+				os.posix_fadvise(fd, max(size - TAIL_READAHEAD, HEADER_READAHEAD), TAIL_READAHEAD, os.POSIX_FADV_WILLNEED)
+		finally:
+			if close:
+				os.close(fd)
+	except OSError:
+		pass
+
+def drop_from_cache(path):
+	if not hasattr(os, "posix_fadvise"):
+		return
+	try:
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+		finally:
+			os.close(fd)
+	except OSError:
+		pass
+
+# time reading the track headers of a library in listing order, then in on-disk order
+def benchmark_io_order(source, mode="inode"):
+	folders = [os.path.join(source, i) for i in os.listdir(source)]
+	folders = [i for i in folders if os.path.isdir(i)]
+
+	library = []
+	for folder in folders:
+		tracks = [os.path.join(folder, i) for i in os.listdir(folder) if os.path.splitext(i)[-1].lower() == ".mp3"]
+		library.append((folder, [i for i in tracks if os.path.isfile(i)]))
+
+	results = {}
+	for ordered in [False, True]:
+		# start both passes from a cold page cache
+		for folder, tracks in library:
+			for track in tracks:
+				drop_from_cache(track)
+
+		stats = new_seek_stats()
+		started = time.monotonic()
+
+		passes = library
+		if ordered:
+			by_folder = dict(library)
+			passes = [(i, by_folder[i]) for i in order_paths([i[0] for i in library], mode, stats)]
+
+		for folder, tracks in passes:
+			if ordered:
+				tracks = order_paths(tracks, mode, stats)
+				for track in tracks:
+					advise_readahead(track)
+			for track in tracks:
+				read_track_header(track, ordered)
+
+		results[mode if ordered else "unordered"] = (time.monotonic() - started, stats)
+
+	return results
+
+def read_track_header(path, sequential=False):
+	with open(path, "rb", buffering=0) as f:
+		if sequential:
+			advise_readahead(path, True, f.fileno())
+		f.read(HEADER_READAHEAD)
+		size = os.fstat(f.fileno()).st_size
+		if size > HEADER_READAHEAD:
+			f.seek(size - TAIL_READAHEAD)
+			f.read(TAIL_READAHEAD)
+
+# parsed Mp3Info headers, keyed by path, size and mtime so modified tracks are parsed again
+class Mp3InfoCache():
+	max_entries = 100000
+	entries = None
+	lock = None
+
+	def __init__(self, max_entries=100000):
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, path):
+		stat = os.stat(path)
+		key = (path, stat.st_size, stat.st_mtime_ns)
+
+		with self.lock:
+			mp3info = self.entries.get(key)
+			if mp3info is not None:
+				self.entries.move_to_end(key)
+				return mp3info
+
+		mp3info = Mp3Info(path)
+
+		with self.lock:
+			self.entries[key] = mp3info
+			if len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+		return mp3info
+
+# long-running validation service, speaking newline-delimited JSON over a Unix socket
+#
+# requests:
+#   {"op": "validate", "folder": path}           queue a validate-only job, returns {"id": n}
+#   {"op": "fix", "folder": path}                queue a job applying the configured fixes and moves
+#   {"op": "result", "id": n, "wait": true}      get (or wait for) the result of a job
+#
+# every response has "ok"; failed requests carry "error", and "busy" means the queue is full
+class ValidationServer():
+	socket_path = None
+	template = None
+	workers = 4
+	queue_size = 64
+	max_finished = 10000
+
+	jobs = None
+	pending = None
+	queue = None
+	condition = None
+	next_id = 1
+	running = None
+	server = None
+
+	def __init__(self, socket_path, template, workers=4, queue_size=64):
+		self.socket_path = socket_path
+		self.template = template
+		self.workers = workers
+		self.queue_size = queue_size
+
+		self.jobs = collections.OrderedDict()
+		self.pending = {}
+		self.queue = collections.deque()
+		self.running = set()
+		self.condition = threading.Condition()
+
+		# parsed headers are shared by all workers, and survive between requests
+		if self.template.mp3info_cache is None:
+			self.template.mp3info_cache = Mp3InfoCache()
+
+	def serve_forever(self):
+		for i in range(self.workers):
+			threading.Thread(target=self.work, daemon=True).start()
+
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)
+
+		service = self
+
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				for line in self.rfile:
+					try:
+						response = service.handle_request(json.loads(line))
+					except (ValueError, KeyError, TypeError) as e:
+						response = {"ok": False, "error": "Bad request: {0}".format(e)}
+					self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+					self.wfile.flush()
+
+		self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+		self.server.daemon_threads = True
+		os.chmod(self.socket_path, 0o660)
+
+		try:
+			self.server.serve_forever()
+		finally:
+			self.server.server_close()
+			os.remove(self.socket_path)
+
+	def shutdown(self):
+		if self.server:
+			self.server.shutdown()
+
+	def handle_request(self, request):
+		op = request["op"]
+
+		if op in ["validate", "fix"]:
+			return self.submit(os.path.abspath(request["folder"]), op == "fix")
+		if op == "result":
+			return self.get_result(int(request["id"]), request.get("wait", False), request.get("timeout"))
+
+		return {"ok": False, "error": "Unknown op {0}".format(op)}
+
+	def submit(self, folder, fix):
+		if not os.path.isdir(folder):
+			return {"ok": False, "error": "Folder {0} does not exist".format(folder)}
+
+		with self.condition:
+			# repeated requests share a job; validate and fix jobs for one folder are queued
+			# separately, but never run at the same time (see next_job)
+			key = (folder, fix)
+			if key in self.pending:
+				return {"ok": True, "id": self.pending[key]}
+
+			if len(self.queue) >= self.queue_size:
+				return {"ok": False, "error": "busy"}
+
+			job_id = self.next_id
+			self.next_id += 1
+			self.jobs[job_id] = {"id": job_id, "status": "queued", "folder": folder, "fix": fix}
+			self.pending[key] = job_id
+			self.queue.append(job_id)
+			self.condition.notify_all()
+
+			return {"ok": True, "id": job_id}
+
+	def get_result(self, job_id, wait=False, timeout=None):
+		with self.condition:
+			if job_id not in self.jobs:
+				return {"ok": False, "error": "Unknown job {0}".format(job_id)}
+
+			if wait:
+				self.condition.wait_for(lambda: self.jobs[job_id]["status"] in ["done", "error"], timeout)
+
+			return dict(self.jobs[job_id], ok=True)
+
+	# the oldest queued job whose folder is not already being worked on
+	def next_job(self):
+		for job_id in self.queue:
+			if self.jobs[job_id]["folder"] not in self.running:
+				return job_id
+		return None
+
+	# each worker owns a pair of blenders, as a blender holds the state of the folder it is checking
+	def work(self):
+		fixer = copy.copy(self.template)
+		validator = copy.copy(self.template)
+		validator.set_read_only()
+
+		while True:
+			with self.condition:
+				job_id = self.condition.wait_for(self.next_job)
+				self.queue.remove(job_id)
+				job = self.jobs[job_id]
+				job["status"] = "running"
+				self.running.add(job["folder"])
+
+			worker = fixer if job["fix"] else validator
+			update = {}
+			try:
+				worker.open_folder(job["folder"])
+				failure_reasons = list(worker.validate_folder() or [])
+				update = {"status": "done", "failure_reasons": failure_reasons,
+						"check_failures": dict(worker.check_failures or {}), "collisions": list(worker.collisions or []),
+						"result_folder": worker.current_folder}
+			except Exception as e:
+				update = {"status": "error", "error": "{0}: {1}".format(type(e).__name__, e)}
+
+				# settle the folder before another job can start on it
+				try:
+					worker.wait_for_tag_writes()
+					worker.discard_staged_copy()
+				except Exception:
+					pass
+				update["failure_reasons"] = list(worker.tag_errors or [])
+			finally:
+				if worker.tracks:
+					for track in worker.tracks:
+						track.close()
+
+			with self.condition:
+				job.update(update)
+				del self.pending[(job["folder"], job["fix"])]
+				self.running.discard(job["folder"])
+
+				# forget the oldest finished jobs
+				while len(self.jobs) > self.max_finished:
+					oldest = next(iter(self.jobs))
+					if self.jobs[oldest]["status"] not in ["done", "error"]:
+						break
+					del self.jobs[oldest]
+
+				self.condition.notify_all()
+
+# blocking client for ValidationServer
+class ValidationClient():
+	socket_path = None
+	connection = None
+	stream = None
+	busy_retry = 0.5
+
+	def __init__(self, socket_path, timeout=None):
+		self.socket_path = socket_path
+		self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.connection.settimeout(timeout)
+		self.connection.connect(socket_path)
+		self.stream = self.connection.makefile("rwb")
+
+	def request(self, message):
+		self.stream.write((json.dumps(message) + "\n").encode("utf-8"))
+		self.stream.flush()
+		line = self.stream.readline()
+		if not line:
+			raise ConnectionError("Validation server at {0} closed the connection".format(self.socket_path))
+		return json.loads(line)
+
+	# queue a job, waiting for room in the server queue if it is full
+	def submit(self, folder, fix=False):
+		while True:
+			response = self.request({"op": "fix" if fix else "validate", "folder": os.path.abspath(folder)})
+			if response["ok"]:
+				return response["id"]
+			if response["error"] != "busy":
+				raise ValueError(response["error"])
+			time.sleep(self.busy_retry)
+
+	def result(self, job_id, wait=True, timeout=None):
+		response = self.request({"op": "result", "id": job_id, "wait": wait, "timeout": timeout})
+		if not response["ok"]:
+			raise ValueError(response["error"])
+		return response
+
+	# validate a folder and wait for the outcome
+	def validate(self, folder, fix=False):
+		return self.result(self.submit(folder, fix))
+
+	def close(self):
+		self.stream.close()
+		self.connection.close()
+
+	def __enter__(self):
+		return self
+	def __exit__(self, *args):
+		self.close()
+
+# names of the entries of each directory, scanned once and kept up to date as folders are renamed and moved,
+# grouped by a case and Unicode normalization insensitive key to catch near-collisions
+class FolderIndex():
+	directories = None
+	listed = None
+	lock = None
+
+	def __init__(self):
+		self.directories = {}
+		self.listed = {}
+		self.lock = threading.RLock()
+
+	def normalize(self, name):
+		return unicodedata.normalize("NFC", name).casefold()
+
+	def get_directory(self, directory):
+		directory = os.path.abspath(directory)
+
+		with self.lock:
+			# re-list whenever the directory has changed since it was listed, i.e. by other shards or processes
+			mtime = get_mtime(directory)
+			listed = self.listed.get(directory)
+			if directory not in self.directories or mtime is None or listed is None or \
+					listed[0] != mtime or not mtime_trusted(mtime, listed[1]):
+				entries = {}
+				checked = time.time_ns()
+				try:
+					for i in os.listdir(directory):
+						entries.setdefault(self.normalize(i), set()).add(i)
+				except OSError:
+					pass
+				self.directories[directory] = entries
+				self.listed[directory] = (mtime, checked)
+			return self.directories[directory]
+
+	# after changing a directory ourselves, the new mtime reflects entries that are already up to date
+	def touch(self, directory):
+		directory = os.path.abspath(directory)
+		if directory in self.listed:
+			self.listed[directory] = (get_mtime(directory), time.time_ns())
+
+	# drop a directory which no longer exists
+	def forget(self, directory):
+		with self.lock:
+			self.directories.pop(os.path.abspath(directory), None)
+			self.listed.pop(os.path.abspath(directory), None)
+
+	def add(self, directory, name):
+		with self.lock:
+			self.get_directory(directory).setdefault(self.normalize(name), set()).add(name)
+			self.touch(directory)
+
+	def remove(self, directory, name):
+		with self.lock:
+			entries = self.get_directory(directory)
+			key = self.normalize(name)
+			if key in entries:
+				entries[key].discard(name)
+				if not entries[key]:
+					del entries[key]
+			self.touch(directory)
+
+	# existing entries which name would collide with, other than ignore (e.g. the folder being renamed)
+	def find_collisions(self, directory, name, ignore=None):
+		with self.lock:
+			existing = self.get_directory(directory).get(self.normalize(name), set())
+
+			collisions = []
+			for i in sorted(existing):
+				if i == ignore:
+					continue
+
+				if i == name:
+					kind = "exact"
+				elif unicodedata.normalize("NFC", i) == unicodedata.normalize("NFC", name):
+					kind = "normalization"
+				else:
+					kind = "case"
+
+				collisions.append({"kind": kind, "name": name, "existing": i, "path": os.path.join(directory, i)})
+
+			return collisions
+
+# a reproducible random subset of folders, optionally stratified by the first character of the folder name
+def select_sample(folders, count, seed=None, stratify=False):
+	rng = random.Random(seed)
+	folders = sorted(folders)
+	count = min(count, len(folders))
+
+	if not stratify:
+		return rng.sample(folders, count)
+
+	strata = {}
+	for folder in folders:
+		key = folder[:1].casefold()
+		if not key.isalnum():
+			key = "#"
+		strata.setdefault(key, []).append(folder)
+
+	# proportional allocation, handing out the rounding remainder to the largest fractions
+	allocation = {}
+	remainders = []
+	for key in sorted(strata):
+		share = count * len(strata[key]) / len(folders)
+		allocation[key] = int(share)
+		remainders.append((share - int(share), key))
+	for fraction, key in sorted(remainders, reverse=True)[:count - sum(allocation.values())]:
+		allocation[key] += 1
+
+	sample = []
+	for key in sorted(strata):
+		sample += rng.sample(strata[key], allocation[key])
+	return sample
+
+# Wilson score interval for a proportion, with the finite population correction applied
+# as an effective sample size of n / fpc^2 (exact once the whole population is sampled)
+def proportion_interval(successes, trials, population, z=1.96):
+	if trials == 0:
+		return 0.0, 0.0, 1.0
+
+	p = successes / trials
+	if trials >= population:
+		return p, p, p
+
+	n = trials * (population - 1) / (population - trials)
+	denominator = 1 + z * z / n
+	centre = (p + z * z / (2 * n)) / denominator
+	margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+
+	# the interval always contains p, but rounding can put p = 0 or 1 just outside it
+	return p, max(min(centre - margin, p), 0.0), min(max(centre + margin, p), 1.0)
+
+# extrapolate per-check failure rates, runtime and I/O of a full run from sampled folder results
+# (each a dict of check_failures, seconds and bytes)
+def estimate_from_sample(samples, population):
+	trials = len(samples)
+
+	checks = {}
+	for sample in samples:
+		for check in sample["check_failures"]:
+			checks[check] = checks.get(check, 0) + 1
+
+	estimate = {"population": population, "sampled": trials, "checks": {}}
+
+	failed = sum(1 for i in samples if i["check_failures"])
+	estimate["failed"] = proportion_interval(failed, trials, population)
+	for check in sorted(checks):
+		estimate["checks"][check] = proportion_interval(checks[check], trials, population)
+
+	if trials:
+		seconds = [i["seconds"] for i in samples]
+		mean = sum(seconds) / trials
+		deviation = math.sqrt(sum((i - mean) ** 2 for i in seconds) / (trials - 1)) if trials > 1 else 0.0
+		estimate["seconds"] = (mean * population, max(mean - 1.96 * deviation / math.sqrt(trials), 0.0) * population,
+				(mean + 1.96 * deviation / math.sqrt(trials)) * population)
+		estimate["bytes"] = sum(i["bytes"] for i in samples) / trials * population
+	else:
+		estimate["seconds"] = (0.0, 0.0, 0.0)
+		estimate["bytes"] = 0
+
+	return estimate
+
+shard_result_format = "music-blender-shard"
+
+# shard (0 to shards-1) a folder belongs to, from a hash of its path relative to the source
+def get_shard(folder, shards):
+	digest = hashlib.sha1(folder.replace(os.path.sep, "/").encode("utf-8")).digest()
+	return int.from_bytes(digest[:8], "big") % shards
+
+def parse_shard(value):
+	match = re.fullmatch(r"(\d+)/(\d+)", value)
+	if not match or int(match.group(2)) < 1 or int(match.group(1)) >= int(match.group(2)):
+		raise ValueError("Shard must be i/n with 0 <= i < n, not {0}".format(value))
+	return int(match.group(1)), int(match.group(2))
+
+def write_shard_result(path, source, shard, shards, results, started):
+	result = {
+		"format": shard_result_format,
+		"version": 1,
+		"source": os.path.abspath(source),
+		"shard": shard,
+		"shards": shards,
+		"host": socket.gethostname(),
+		"started": started,
+		"finished": time.time(),
+		"folders": results,
+		"total_failure_reasons": sum(len(i["failure_reasons"]) for i in results),
+	}
+
+	tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+	with open(tmp_path, "w", encoding="utf-8") as f:
+		json.dump(result, f, indent=1)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, path)
+
+# combine shard result files into one, listing anything which makes the merge incomplete or ambiguous
+def merge_shard_results(paths):
+	problems = []
+	shards = {}
+	source = None
+	shard_count = None
+
+	for path in paths:
+		try:
+			with open(path, encoding="utf-8") as f:
+				result = json.load(f)
+		except (OSError, ValueError) as e:
+			problems.append("Unreadable shard file {0}: {1}".format(path, e))
+			continue
+
+		if result.get("format") != shard_result_format:
+			problems.append("{0} is not a shard result file".format(path))
+			continue
+
+		if source is None:
+			source = result["source"]
+			shard_count = result["shards"]
+		elif result["source"] != source or result["shards"] != shard_count:
+			problems.append("{0} is shard {1}/{2} of {3}, expected a shard of {4}/{5}".format(
+				path, result["shard"], result["shards"], result["source"], shard_count, source))
+			continue
+
+		if result["shard"] in shards:
+			problems.append("Duplicate shard {0}/{1}: {2} and {3}".format(result["shard"], shard_count, shards[result["shard"]][0], path))
+			continue
+		shards[result["shard"]] = (path, result)
+
+	if shard_count is not None:
+		for i in range(shard_count):
+			if i not in shards:
+				problems.append("Missing shard {0}/{1}".format(i, shard_count))
+
+	folders = {}
+	for i in sorted(shards):
+		path, result = shards[i]
+		for record in result["folders"]:
+			if record["folder"] in folders:
+				problems.append("Folder {0} appears in more than one shard".format(record["folder"]))
+				continue
+			# folders belonging to another shard mean the shards were not cut the same way
+			if get_shard(record["folder"], shard_count) != i:
+				problems.append("Folder {0} does not belong to shard {1}/{2}".format(record["folder"], i, shard_count))
+			folders[record["folder"]] = record
+
+	merged = {
+		"source": source,
+		"shards": shard_count,
+		"folders": [folders[i] for i in sorted(folders)],
+		"total_failure_reasons": sum(len(i["failure_reasons"]) for i in folders.values()),
+	}
+	return merged, problems
+
+# persisted fingerprints of album folder trees, so unchanged folders can be confirmed with one stat per directory
+# and their last verdict reused. Only directory mtimes are compared on rescan, so this relies on files being
+# added, removed or replaced by rename (as tag writes are) rather than rewritten in place by other tools.
+class TreeCache():
+	path = None
+	source = None
+	options = None
+	records = None
+	unsaved = 0
+	save_interval = 500
+
+	def __init__(self, path, source, options):
+		self.path = path
+		self.source = os.path.abspath(source)
+		self.options = options
+		self.records = {}
+
+		if os.path.exists(path):
+			with open(path, encoding="utf-8") as f:
+				cache = json.load(f)
+			if cache.get("source") == self.source:
+				self.records = cache["folders"]
+
+	# the previous record for a folder, if it was checked with the same options and its tree has not changed since
+	def get_verdict(self, folder):
+		record = self.records.get(folder)
+		if record is None or record["options"] != self.options:
+			return None
+
+		for directory in record["directories"]:
+			recorded = record["directories"][directory]
+			try:
+				mtime = os.stat(os.path.join(self.source, folder, directory)).st_mtime_ns
+			except OSError:
+				return None
+			if mtime != recorded["mtime"] or not mtime_trusted(mtime, record["checked"]):
+				return None
+
+		return record
+
+	def update(self, folder, failure_reasons, check_failures):
+		started = time.time_ns()
+		directories = fingerprint_tree(os.path.join(self.source, folder))
+		if directories is None:
+			self.records.pop(folder, None)
+			return
+
+		self.records[folder] = {
+			"options": self.options,
+			"checked": started,
+			"directories": directories,
+			"failure_reasons": failure_reasons,
+			"check_failures": check_failures,
+		}
+
+		self.unsaved += 1
+		if self.unsaved >= self.save_interval:
+			self.save()
+
+	def forget(self, folder):
+		if self.records.pop(folder, None) is not None:
+			self.unsaved += 1
+
+	# drop folders which are no longer in the source (i.e. moved away)
+	def prune(self):
+		for folder in list(self.records):
+			if not os.path.isdir(os.path.join(self.source, folder)):
+				del self.records[folder]
+
+	def save(self):
+		tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			json.dump({"source": self.source, "folders": self.records}, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path)
+		self.unsaved = 0
+
+# mtime, entry count and a digest of the (name, size, mtime) entries of every directory in a tree,
+# keyed by path relative to the tree root
+def fingerprint_tree(path):
+	directories = {}
+	try:
+		for root, subfolders, names in os.walk(path):
+			digest = hashlib.blake2b(digest_size=16)
+			entries = sorted(subfolders + names)
+			for i in entries:
+				stat = os.stat(os.path.join(root, i))
+				digest.update("{0}\0{1}\0{2}\0".format(i, stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+
+			directories[os.path.relpath(root, path)] = {
+				"mtime": os.stat(root).st_mtime_ns,
+				"entries": len(entries),
+				"digest": digest.hexdigest(),
+			}
+	except OSError:
+		return None
+
+	return directories or None
+
+# a directory mtime only proves nothing changed if the directory could not have changed again within the
+# same timestamp tick after it was recorded; whole-second mtimes suggest a coarse (up to 2s, FAT) filesystem
+def mtime_trusted(mtime, checked):
+	granularity = 2 * 10**9 if mtime % 10**9 == 0 else 10**7
+	return checked - mtime > granularity
+
+# dictionary encoding for repeated strings; code 0 is reserved for missing values
+class StringDictionary():
+	codes = None
+	values = None
+
+	def __init__(self):
+		self.codes = {}
+		self.values = [None]
+
+	def encode(self, value):
+		if value is None:
+			return 0
+		code = self.codes.get(value)
+		if code is None:
+			code = len(self.values)
+			self.codes[value] = code
+			self.values.append(value)
+		return code
+
+	def decode(self, code):
+		return self.values[code]
+
+# library-wide statistics, kept as compact typed columns (a few bytes per track) and aggregated with NumPy
+class LibraryStats():
+	strings = None
+
+	def __init__(self):
+		self.strings = {"bitrate": StringDictionary(), "lame_version": StringDictionary(), "check": StringDictionary()}
+
+		# one row per track
+		self.track_album = array.array("I")
+		self.track_bitrate_class = array.array("H")
+		self.track_lame_version = array.array("H")
+		self.track_vbr_method = array.array("b")
+		self.track_bitrate = array.array("H")
+		self.track_year = array.array("H")
+		self.track_disc = array.array("B")
+
+		# one row per album
+		self.album_bitrate_class = array.array("H")
+
+		# one row per (album, failing check)
+		self.failure_album = array.array("I")
+		self.failure_check = array.array("H")
+		self.failure_count = array.array("H")
+
+	def add_album(self, blender):
+		album = len(self.album_bitrate_class)
+		bitrates = self.strings["bitrate"]
+		lame_versions = self.strings["lame_version"]
+
+		for track in blender.tracks or []:
+			self.track_album.append(album)
+			self.track_bitrate_class.append(bitrates.encode(get_track_bitrate(track)))
+			self.track_lame_version.append(lame_versions.encode(track.mp3info.lame_version))
+			self.track_vbr_method.append(track.mp3info.lame_vbr_method if track.mp3info.lame_vbr_method is not None else -1)
+			self.track_bitrate.append(min(track.bitrate or 0, 65535))
+			self.track_year.append(parse_number(track.get_tag('DATE'), "-", 65535))
+			self.track_disc.append(parse_number(track.get_tag('DISCNUMBER'), "/", 255))
+
+		self.album_bitrate_class.append(bitrates.encode(blender.get_overall_bitrate() if blender.tracks else None))
+
+		for check in blender.check_failures or {}:
+			self.failure_album.append(album)
+			self.failure_check.append(self.strings["check"].encode(check))
+			self.failure_count.append(min(blender.check_failures[check], 65535))
+
+	def get_columns(self):
+		return [self.track_album, self.track_bitrate_class, self.track_lame_version, self.track_vbr_method, self.track_bitrate,
+				self.track_year, self.track_disc, self.album_bitrate_class, self.failure_album, self.failure_check, self.failure_count]
+
+	def get_bytes_per_track(self):
+		size = sum(i.itemsize * len(i) for i in self.get_columns())
+		return size / max(len(self.track_album), 1)
+
+	def get_report(self):
+		if numpy is None:
+			raise ImportError("NumPy is required for library statistics")
+
+		def column(values, dtype):
+			return numpy.frombuffer(values, dtype=dtype) if len(values) else numpy.zeros(0, dtype=dtype)
+
+		def counts(codes, dictionary=None, offset=0):
+			totals = numpy.bincount(codes.astype(numpy.int64) + offset) if len(codes) else numpy.zeros(0, dtype=numpy.int64)
+			report = {}
+			for code in numpy.flatnonzero(totals):
+				key = dictionary.decode(code) if dictionary else int(code) - offset
+				report[str(key)] = int(totals[code])
+			return report
+
+		albums = len(self.album_bitrate_class)
+		album = column(self.track_album, numpy.uint32)
+		year = column(self.track_year, numpy.uint16)
+		disc = column(self.track_disc, numpy.uint8)
+
+		# group-bys over the album column
+		tracks_per_album = numpy.bincount(album, minlength=albums) if albums else numpy.zeros(0, dtype=numpy.int64)
+		album_year = numpy.zeros(albums, dtype=numpy.uint16)
+		numpy.maximum.at(album_year, album, year)
+		# distinct tagged discs only, a missing disc tag (0) is not a disc of its own
+		tagged = disc > 0
+		album_discs = numpy.unique(album[tagged].astype(numpy.uint64) * 256 + disc[tagged])
+		discs_per_album = numpy.bincount((album_discs // 256).astype(numpy.int64), minlength=albums) if albums else numpy.zeros(0, dtype=numpy.int64)
+
+		failure_check = column(self.failure_check, numpy.uint16)
+		failure_count = column(self.failure_count, numpy.uint16)
+		errors_per_check = numpy.bincount(failure_check, weights=failure_count) if len(failure_check) else numpy.zeros(0)
+
+		return {
+			"albums": albums,
+			"tracks": len(self.track_album),
+			"bytes_per_track": self.get_bytes_per_track(),
+			"album_bitrates": counts(column(self.album_bitrate_class, numpy.uint16), self.strings["bitrate"]),
+			"track_bitrates": counts(column(self.track_bitrate_class, numpy.uint16), self.strings["bitrate"]),
+			"lame_versions": counts(column(self.track_lame_version, numpy.uint16), self.strings["lame_version"]),
+			"vbr_methods": counts(column(self.track_vbr_method, numpy.int8), offset=1),
+			"album_years": counts(album_year[album_year > 0]),
+			"tracks_per_album": counts(tracks_per_album),
+			"discs_per_album": counts(discs_per_album),
+			"multi_disc_albums": int(numpy.count_nonzero(discs_per_album > 1)),
+			"albums_failing_check": counts(failure_check, self.strings["check"]),
+			"errors_per_check": dict((self.strings["check"].decode(i), int(errors_per_check[i])) for i in numpy.flatnonzero(errors_per_check)),
+		}
+
+# leading number of a tag value such as 2004-05-01 or 3/12, 0 if missing or unparseable
+def parse_number(value, separator, maximum):
+	if not value:
+		return 0
+	try:
+		return min(max(int(value.split(separator)[0]), 0), maximum)
+	except ValueError:
+		return 0
+
+# background tag writes: each save goes to a temporary copy of the track which is then renamed over it, so a crash
+# leaves either the old or the new file. Saves of the same track are coalesced and applied in order, and directory
+# fsyncs are batched until someone waits on the writes
+class TagWriter():
+	pool = None
+	slots = None
+	lock = None
+	latest = None
+	states = None
+	futures = None
+	path_locks = None
+	errors = None
+	dirty_directories = None
+
+	def __init__(self, workers=4, max_pending=64):
+		self.pool = ThreadPoolExecutor(max_workers=workers)
+		self.slots = threading.BoundedSemaphore(max_pending)
+		self.lock = threading.Lock()
+		self.latest = {}
+		self.states = {}
+		self.futures = {}
+		self.path_locks = {}
+		self.errors = {}
+		self.dirty_directories = set()
+
+	def submit(self, path, tags):
+		snapshot = dict((i, list(tags[i])) for i in tags)
+
+		with self.lock:
+			self.latest[path] = snapshot
+			# a write which has not started yet will pick up the newest tags
+			if self.states.get(path) == "queued":
+				return
+			self.states[path] = "queued"
+
+		# blocks the caller while the queue is full
+		self.slots.acquire()
+		future = self.pool.submit(self.write, path)
+		with self.lock:
+			self.futures.setdefault(path, []).append(future)
+
+	def write(self, path):
+		try:
+			with self.lock:
+				path_lock = self.path_locks.setdefault(path, threading.Lock())
+
+			with path_lock:
+				with self.lock:
+					tags = self.latest.pop(path)
+					self.states[path] = "running"
+
+				try:
+					save_tags_atomically(path, tags)
+					with self.lock:
+						self.dirty_directories.add(os.path.dirname(path))
+				except Exception as e:
+					with self.lock:
+						self.errors[path] = e
+				finally:
+					with self.lock:
+						if self.states.get(path) == "running":
+							del self.states[path]
+		finally:
+			self.slots.release()
+
+	# wait until every write of the given paths is on disk; returns (path, error) for those that failed
+	def wait(self, paths):
+		futures = []
+		with self.lock:
+			for path in paths:
+				futures += self.futures.pop(path, [])
+
+		for future in futures:
+			future.result()
+
+		with self.lock:
+			directories = set(os.path.dirname(i) for i in paths) & self.dirty_directories
+			self.dirty_directories -= directories
+			failures = [(i, self.errors.pop(i)) for i in paths if i in self.errors]
+			for path in paths:
+				if path not in self.states:
+					self.path_locks.pop(path, None)
+
+		# one fsync per directory makes all the renames into it durable
+		for directory in directories:
+			try:
+				fd = os.open(directory, os.O_RDONLY)
+				try:
+					os.fsync(fd)
+				finally:
+					os.close(fd)
+			except OSError:
+				pass
+
+		return failures
+
+	def shutdown(self):
+		self.pool.shutdown(wait=True)
+
+# carry the owner, group, mode and extended attributes of a track over to its replacement
+# (hard links to the original are not carried over, they keep the old file)
+def copy_file_attributes(src, dst):
+	stat = os.stat(src)
+
+	# fails unless permitted, rather than silently handing the track to whoever is running the fix
+	if hasattr(os, "chown"):
+		dst_stat = os.stat(dst)
+		if (dst_stat.st_uid, dst_stat.st_gid) != (stat.st_uid, stat.st_gid):
+			os.chown(dst, stat.st_uid, stat.st_gid)
+
+	shutil.copymode(src, dst)
+
+	if hasattr(os, "listxattr"):
+		try:
+			for name in os.listxattr(src):
+				os.setxattr(dst, name, os.getxattr(src, name))
+		except OSError as e:
+			if e.errno not in [errno.ENOTSUP, errno.EOPNOTSUPP]:
+				raise
+
+# write tags to a copy of a track in the same folder, then atomically replace the track with it
+def save_tags_atomically(path, tags):
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=tag_temp_prefix, suffix=os.path.splitext(path)[1])
+	os.close(fd)
+
+	try:
+		with open(path, "rb") as fsrc, open(tmp_path, "wb") as fdst:
+			if not reflink_file(fsrc, fdst):
+				copy_file_data(fsrc, fdst, os.fstat(fsrc.fileno()).st_size)
+		copy_file_attributes(path, tmp_path)
+
+		metadata = taglib.File(tmp_path)
+		try:
+			metadata.tags.clear()
+			metadata.tags.update(tags)
+			retval = metadata.save()
+		finally:
+			metadata.close()
+		if len(retval) != 0:
+			raise ValueError("unsupported tags {0}".format(", ".join(retval)))
+
+		with open(tmp_path, "rb+") as f:
+			os.fsync(f.fileno())
+		os.replace(tmp_path, path)
+	except BaseException:
+		try:
+			os.remove(tmp_path)
+		except OSError:
+			pass
+		raise
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+# JPEG start-of-frame markers, which carry the image dimensions
+JPEG_SOF_MARKERS = [0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF]
+
+# format, dimensions and truncation of the image stored in bytes start to end of a file, without decoding it
+def read_image_header(f, start, end):
+	image = {"format": None, "width": 0, "height": 0, "truncated": False, "error": None, "size": end - start}
+
+	f.seek(start)
+	head = f.read(min(end - start, 4096))
+
+	def read_at(offset, count):
+		if offset + count <= len(head):
+			return head[offset:offset + count]
+		if start + offset + count > end:
+			return b""
+		f.seek(start + offset)
+		return f.read(count)
+
+	if head.startswith(PNG_SIGNATURE):
+		image["format"] = "png"
+		if len(head) < 24 or head[12:16] != b"IHDR":
+			image["error"] = "missing IHDR chunk"
+			return image
+		image["width"], image["height"] = struct.unpack(">II", head[16:24])
+		image["truncated"] = read_at(end - start - len(PNG_IEND), len(PNG_IEND)) != PNG_IEND
+
+	elif head.startswith(b"\xff\xd8"):
+		image["format"] = "jpeg"
+
+		# walk the marker segments up to the frame header
+		offset = 2
+		while True:
+			marker = read_at(offset, 4)
+			if len(marker) < 4 or marker[0] != 0xFF:
+				image["error"] = "no frame header found"
+				return image
+
+			code = marker[1]
+			if code == 0xFF:
+				offset += 1
+				continue
+			if code == 0x01 or 0xD0 <= code <= 0xD7:
+				offset += 2
+				continue
+			if code in [0xD9, 0xDA]:
+				image["error"] = "no frame header found"
+				return image
+
+			length = struct.unpack(">H", marker[2:4])[0]
+			if code in JPEG_SOF_MARKERS:
+				frame = read_at(offset + 5, 4)
+				if len(frame) < 4:
+					image["error"] = "frame header cut short"
+					return image
+				image["height"], image["width"] = struct.unpack(">HH", frame)
+				break
+			offset += 2 + length
+
+		# allow for a little padding after the end-of-image marker
+		tail = read_at(max(end - start - 32, 0), min(end - start, 32)).rstrip(b"\x00")
+		image["truncated"] = not tail.endswith(b"\xff\xd9")
+
+	else:
+		image["error"] = "not a PNG or JPEG image"
+
+	if not image["error"] and (image["width"] == 0 or image["height"] == 0):
+		image["error"] = "zero image dimensions"
+
+	return image
+
+def syncsafe(data):
+	return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+# headers of the pictures in a track's ID3v2 APIC (PIC in v2.2) frames, seeking past everything else
+def read_embedded_images(path):
+	images = []
+
+	with open(path, "rb") as f:
+		header = f.read(10)
+		if len(header) < 10 or header[0:3] != b"ID3":
+			return images
+
+		version = header[3]
+		flags = header[5]
+		tag_end = 10 + syncsafe(header[6:10])
+
+		# unsynchronised tags would need the whole tag de-unsynchronised to find the images
+		if flags & 0x80 or version not in [2, 3, 4]:
+			return images
+
+		offset = 10
+		if flags & 0x40 and version != 2:
+			extended = f.read(4)
+			offset += syncsafe(extended) if version == 4 else 4 + struct.unpack(">I", extended)[0]
+
+		header_size = 6 if version == 2 else 10
+		while offset + header_size <= tag_end:
+			f.seek(offset)
+			frame_header = f.read(header_size)
+
+			if version == 2:
+				frame_id = frame_header[0:3]
+				size = int.from_bytes(frame_header[3:6], "big")
+				frame_flags = 0
+			else:
+				frame_id = frame_header[0:4]
+				size = syncsafe(frame_header[4:8]) if version == 4 else struct.unpack(">I", frame_header[4:8])[0]
+				frame_flags = frame_header[9]
+
+			# padding
+			if frame_id[0:1] in [b"\x00", b""]:
+				break
+
+			data_start = offset + header_size
+			data_end = data_start + size
+			offset = data_end
+			if data_end > tag_end:
+				break
+
+			if frame_id not in [b"APIC", b"PIC"]:
+				continue
+
+			# compressed, encrypted or unsynchronised frame contents can't be read in place
+			if frame_flags & (0x0F if version == 4 else 0xC0):
+				continue
+
+			f.seek(data_start)
+			prefix = f.read(min(size, 1024))
+			image_start = get_apic_image_offset(prefix, version)
+			if image_start is None:
+				images.append({"format": None, "width": 0, "height": 0, "truncated": False, "error": "malformed picture frame", "size": size})
+				continue
+
+			images.append(read_image_header(f, data_start + image_start, data_end))
+
+	return images
+
+# offset of the picture data in an APIC frame: after the encoding, MIME type (or v2.2 format), picture type
+# and description
+def get_apic_image_offset(data, version):
+	if len(data) < 2:
+		return None
+
+	encoding = data[0]
+	if version == 2:
+		offset = 4
+	else:
+		offset = data.find(b"\x00", 1)
+		if offset < 0:
+			return None
+		offset += 1
+	offset += 1
+
+	# the description is null terminated, with a double null for UTF-16
+	if encoding in [1, 2]:
+		while True:
+			end = data.find(b"\x00\x00", offset)
+			if end < 0:
+				return None
+			if (end - offset) % 2 == 0:
+				return end + 2
+			offset = end + 1
+	end = data.find(b"\x00", offset)
+	if end < 0:
+		return None
+	return end + 1
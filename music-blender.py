@@ -1,4 +1,7 @@
 import os
+import sys
+import time
+import json
 import argparse
 from colorama import Fore, Back, Style, init as colorama_init
 import mblib
@@ -9,6 +12,28 @@ def string_colour(string, color):
 def string_background(string, color):
 	return "".join([color, string, Style.RESET_ALL])
 
+def print_result(name, failure_reasons, last_failed, cached=None):
+	if telemetry:
+		telemetry.clear()
+
+	if cached:
+		name = "{0} ({1})".format(name, cached)
+
+	if len(failure_reasons) != 0:
+
+		if last_failed is False:
+			print("-----------------------------------")
+		print("{0} {1}".format(string_colour("[FAIL]", Fore.RED), name))
+
+		for reason in failure_reasons:
+			print(string_background(reason, Back.RED))
+		print("-----------------------------------")
+
+		return True
+
+	print("{0} {1}".format(string_colour("[PASS]", Fore.GREEN), name))
+	return False
+
 #colorama
 colorama_init(autoreset=True)
 
@@ -18,6 +43,33 @@ except:
 	print("""Unicode error - run the program again.""")
 	os.system("chcp 65001")
 	exit()
+
+telemetry = None
+
+# merge subcommand, combining the result files of a sharded scan
+if len(sys.argv) > 1 and sys.argv[1] == "merge":
+	merge_parser = argparse.ArgumentParser(prog='music-blender.py merge', description='Merge the result files of a sharded scan.')
+	merge_parser.add_argument('shard_files', metavar='file', type=str, nargs='+',
+	                   help='Result files written with --shard-output')
+	merge_parser.add_argument('--output', metavar='file', type=str,
+	                   help='Write the merged report to this file')
+	merge_args = merge_parser.parse_args(sys.argv[2:])
+
+	merged, problems = mblib.merge_shard_results(merge_args.shard_files)
+
+	last_failed = False
+	for record in merged["folders"]:
+		last_failed = print_result(record["folder"], record["failure_reasons"], last_failed)
+
+	if merge_args.output:
+		with open(merge_args.output, "w", encoding="utf-8") as f:
+			json.dump(dict(merged, problems=problems), f, indent=1)
+
+	for problem in problems:
+		print(string_background(problem, Back.RED))
+
+	print("Total tag errors: {0}".format(merged["total_failure_reasons"]))
+	sys.exit(1 if problems else 0)
 	
 #argparse
 parser = argparse.ArgumentParser(description='Validate a music collection.', prefix_chars='--',
@@ -28,12 +80,76 @@ Operation modes:
   	inplace - applies fixes to the files and leaves them in the source folder'''
             )
 
-parser.add_argument('source', metavar='directory', type=str,
+parser.add_argument('source', metavar='directory', type=str, nargs='?',
                    help='Top level folder containing all albums')
-parser.add_argument('--move-to', metavar='destination', type=str,
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument('--move-to', metavar='destination', type=str,
                    help='Move folders which pass validation to this destination')
+mode.add_argument('--copy-to', metavar='destination', type=str,
+                   help='Copy folders which pass validation to this destination, fixes are only applied to the copies')
+parser.add_argument('--copy-workers', metavar='n', type=int, default=4,
+                   help='Number of files of an album to copy in parallel')
+parser.add_argument('--checkpoint', metavar='file', type=str,
+                   help='Record each finished folder in this file, for use with --resume')
+parser.add_argument('--resume', action='store_true',
+                   help='Skip folders already recorded in the checkpoint file, unless modified since')
+parser.add_argument('--metrics-textfile', metavar='file', type=str,
+                   help='Periodically write throughput metrics to this Prometheus node-exporter textfile')
+parser.add_argument('--metrics-interval', metavar='seconds', type=float, default=15,
+                   help='Interval between metrics textfile updates')
+parser.add_argument('--no-progress', action='store_true',
+                   help='Do not show the live progress line')
+parser.add_argument('--io-order', choices=mblib.IO_ORDERS,
+                   help='Visit folders and tracks in on-disk order (by inode number, or physical extent via FIEMAP) to reduce seeks')
+parser.add_argument('--benchmark-io', action='store_true',
+                   help='Compare reading track headers in listing order and in --io-order order, then exit')
+parser.add_argument('--daemon', metavar='socket', type=str,
+                   help='Run as a validation service listening on this Unix socket, instead of scanning a directory')
+parser.add_argument('--workers', metavar='n', type=int, default=4,
+                   help='Number of folders the validation service checks concurrently')
+parser.add_argument('--queue-size', metavar='n', type=int, default=64,
+                   help='Number of folders the validation service queues before rejecting requests as busy')
+sample = parser.add_mutually_exclusive_group()
+sample.add_argument('--sample', metavar='n', type=int,
+                   help='Estimate library health from a random sample of n folders; never applies fixes or moves')
+sample.add_argument('--sample-fraction', metavar='p', type=float,
+                   help='As --sample, sampling this fraction (0-1) of the folders')
+parser.add_argument('--seed', metavar='n', type=int, default=0,
+                   help='Random seed for --sample, so samples are reproducible')
+parser.add_argument('--stratify', action='store_true',
+                   help='Sample proportionally from folders grouped by their first character')
+parser.add_argument('--shard', metavar='i/n', type=str,
+                   help='Only check the folders in shard i of n (0 <= i < n), for splitting a scan across machines')
+parser.add_argument('--shard-output', metavar='file', type=str,
+                   help='Write the results of this scan to this file, for combining with "music-blender.py merge"')
+parser.add_argument('--tree-cache', metavar='file', type=str,
+                   help='Remember folder tree fingerprints and results in this file, and reuse the results of folders '
+                   'whose directories are unchanged on the next scan. Assumes files are not rewritten in place by other tools')
+parser.add_argument('--stats', action='store_true',
+                   help='Report library-wide statistics (bitrates, encoders, years, track and disc counts, failures) '
+                   'instead of listing results; never applies fixes or moves. Requires NumPy')
+parser.add_argument('--stats-output', metavar='file', type=str,
+                   help='Also write the --stats report to this file as JSON')
+parser.add_argument('--tag-writers', metavar='n', type=int, default=0 if os.name == "nt" else 4,
+                   help='Number of background threads writing tag fixes, via a temporary file renamed over the track. '
+                   'The replacement keeps the owner, group, mode and extended attributes, but hard links to the track '
+                   'keep pointing at the old file. 0 saves tags in place on the validation thread (the default on Windows, '
+                   'which cannot replace a track that is still open)')
 parser.add_argument('--delete-disallowed-files', action='store_true',
                    help='Delete superfluous files in album base directories')
+parser.add_argument('--check-cover-art', action='store_true',
+                   help='Check image files and embedded album art are intact and within the size limits, reading only image headers')
+parser.add_argument('--cover-min-size', metavar='pixels', type=int, default=300,
+                   help='Smallest allowed cover art width/height (0 to disable)')
+parser.add_argument('--cover-max-size', metavar='pixels', type=int, default=5000,
+                   help='Largest allowed cover art width/height (0 to disable)')
+parser.add_argument('--cover-max-bytes', metavar='bytes', type=int, default=10 * 1024 * 1024,
+                   help='Largest allowed cover art file size (0 to disable)')
+parser.add_argument('--multi-disc', action='store_true',
+                   help='Treat disc subfolders (CD1, Disc 2, ...) as one album, inferring disc numbers from their names')
+parser.add_argument('--disc-folder-pattern', metavar='regex', type=str, action='append',
+                   help='Regular expression matching disc subfolder names, with the disc number as its first group '
+                   '(may be repeated; replaces the default CD/Disc/Disk pattern)')
 parser.add_argument('--fix-track-numbers', action='store_true',
                    help='Attempt to fix missing track numbers')
 parser.add_argument('--fix-track-number-of', action='store_true',
@@ -59,6 +175,15 @@ blender = mblib.blender()
 
 if args.move_to:
 	blender.set_move_to(args.move_to)
+if args.copy_to:
+	try:
+		blender.set_copy_to(args.copy_to)
+	except ValueError as e:
+		parser.error(e)
+blender.copy_workers = args.copy_workers
+blender.io_order = args.io_order
+if args.tag_writers > 0:
+	blender.tag_writer = mblib.TagWriter(args.tag_writers)
 
 
 blender.delete_disallowed_files = args.delete_disallowed_files
@@ -70,17 +195,186 @@ blender.fix_disc_numbers = args.fix_disc_numbers
 blender.fix_disc_number_of = args.fix_disc_number_of
 blender.fix_filenames = args.fix_filenames
 blender.fix_foldernames = args.fix_foldernames
+blender.check_cover_art = args.check_cover_art
+blender.multi_disc = args.multi_disc
+if args.disc_folder_pattern:
+	try:
+		blender.set_disc_folder_patterns(args.disc_folder_pattern)
+	except ValueError as e:
+		parser.error(e)
+blender.cover_min_dimension = args.cover_min_size
+blender.cover_max_dimension = args.cover_max_size
+blender.cover_max_bytes = args.cover_max_bytes
+
+if args.daemon:
+	server = mblib.ValidationServer(args.daemon, blender, args.workers, args.queue_size)
+	print("Listening on {0}".format(args.daemon))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	exit()
+
+if not source:
+	parser.error("the directory argument is required unless running with --daemon")
 
 if not os.path.isdir(source):
 	print("Source folder {0} does not exist".format(source))
 	exit()
 
+if args.benchmark_io:
+	results = mblib.benchmark_io_order(source, args.io_order or "inode")
+	for mode in results:
+		elapsed, stats = results[mode]
+		print("{0}: {1:.2f}s".format(mode, elapsed))
+		if stats["items"]:
+			print("  {0}".format(mblib.format_seek_stats(stats)))
+	exit()
+
+if args.sample is not None and args.sample < 0:
+	parser.error("--sample must not be negative")
+if args.sample_fraction is not None and not 0 <= args.sample_fraction <= 1:
+	parser.error("--sample-fraction must be between 0 and 1")
+
+if args.sample is not None or args.sample_fraction is not None:
+	population = sorted(i for i in os.listdir(source) if os.path.isdir(os.path.join(source, i)))
+	count = args.sample if args.sample is not None else int(round(args.sample_fraction * len(population)))
+	selected = mblib.select_sample(population, count, args.seed, args.stratify)
+
+	# whatever else was asked for, sampling only ever looks
+	blender.set_read_only()
+	blender.telemetry = mblib.Telemetry(len(selected))
+
+	print("Sampling {0} of {1} folders (seed {2})...".format(len(selected), len(population), args.seed))
+
+	samples = []
+	for curr in selected:
+		started = time.monotonic()
+		bytes_before = blender.telemetry.bytes_opened
+
+		blender.open_folder(os.path.join(source, curr))
+		blender.validate_folder()
+
+		samples.append({"check_failures": blender.check_failures or {}, "seconds": time.monotonic() - started,
+				"bytes": blender.telemetry.bytes_opened - bytes_before})
+
+	estimate = mblib.estimate_from_sample(samples, len(population))
+
+	def format_interval(interval):
+		rate, low, high = interval
+		return "{0:5.1f}% ({1:.1f}-{2:.1f}%, ~{3} folders)".format(100 * rate, 100 * low, 100 * high, int(round(rate * len(population))))
+
+	print("Folders failing:  {0}".format(format_interval(estimate["failed"])))
+	for check in estimate["checks"]:
+		print("  {0:<18}{1}".format(check, format_interval(estimate["checks"][check])))
+	seconds, low, high = estimate["seconds"]
+	print("Estimated full run: {0} ({1}-{2}), {3:.1f} GB of tracks opened".format(
+		mblib.format_duration(seconds), mblib.format_duration(low), mblib.format_duration(high), estimate["bytes"] / 1e9))
+	print("Intervals are 95% confidence")
+	exit()
+
+shard = None
+if args.shard:
+	try:
+		shard = mblib.parse_shard(args.shard)
+	except ValueError as e:
+		parser.error(e)
+
+if args.stats:
+	# fail before the scan, not after it
+	if mblib.numpy is None:
+		print("NumPy is required for library statistics")
+		exit()
+
+	blender.set_read_only()
+	stats = mblib.LibraryStats()
+
+	folders = [i for i in os.listdir(source) if os.path.isdir(os.path.join(source, i))]
+	if shard:
+		folders = [i for i in folders if mblib.get_shard(i, shard[1]) == shard[0]]
+	if args.io_order:
+		folders = [os.path.basename(i) for i in mblib.order_paths([os.path.join(source, i) for i in folders], args.io_order, blender.io_stats)]
+
+	print("Collecting statistics for {0} folders...".format(len(folders)))
+
+	for curr in folders:
+		blender.open_folder(os.path.join(source, curr))
+		blender.validate_folder()
+		stats.add_album(blender)
+
+		for track in blender.tracks or []:
+			track.close()
+
+	try:
+		report = stats.get_report()
+	except ImportError as e:
+		print(e)
+		exit()
+
+	print("Albums: {0}, tracks: {1}, {2:.1f} bytes per track".format(report["albums"], report["tracks"], report["bytes_per_track"]))
+	for section in ["album_bitrates", "track_bitrates", "lame_versions", "vbr_methods", "album_years", "tracks_per_album",
+			"discs_per_album", "albums_failing_check", "errors_per_check"]:
+		print("{0}:".format(section.replace("_", " ").capitalize()))
+		for key in sorted(report[section], key=lambda i: -report[section][i]):
+			print("  {0:<24}{1}".format(key, report[section][key]))
+	print("Multi-disc albums: {0}".format(report["multi_disc_albums"]))
+
+	if args.stats_output:
+		with open(args.stats_output, "w", encoding="utf-8") as f:
+			json.dump(report, f, indent=1)
+	exit()
+
+if args.resume and not args.checkpoint:
+	print("--resume requires --checkpoint")
+	exit()
+
+checkpoint = None
+if args.checkpoint:
+	try:
+		checkpoint = mblib.Checkpoint(args.checkpoint, source, args.resume)
+	except ValueError as e:
+		print(e)
+		exit()
+
+tree_cache = None
+if args.tree_cache:
+	options = dict((i, getattr(blender, i)) for i in mblib.fix_options)
+	options.update(move_to=blender.move_to, copy_to=blender.copy_to)
+	options.update(check_cover_art=blender.check_cover_art, cover_min_dimension=blender.cover_min_dimension,
+			cover_max_dimension=blender.cover_max_dimension, cover_max_bytes=blender.cover_max_bytes)
+	options.update(multi_disc=blender.multi_disc, disc_folder_patterns=blender.disc_folder_patterns)
+	tree_cache = mblib.TreeCache(args.tree_cache, source, options)
+
+started = time.time()
 folders = os.listdir(source)
+
+if shard:
+	folders = [i for i in folders if mblib.get_shard(i, shard[1]) == shard[0]]
+
+if args.io_order:
+	folders = [os.path.basename(i) for i in mblib.order_paths([os.path.join(source, i) for i in folders], args.io_order, blender.io_stats)]
+
 print("Scanning {0} subfolders...".format(len(folders)))
 
+telemetry = None
+show_progress = not args.no_progress and sys.stderr.isatty()
+if show_progress or args.metrics_textfile:
+	total_folders = sum(1 for i in folders if os.path.isdir(os.path.join(source, i)))
+	telemetry = mblib.Telemetry(total_folders, args.metrics_textfile, show_progress)
+	telemetry.textfile_interval = args.metrics_interval
+	blender.telemetry = telemetry
+
 last_failed = False
 
 total_failure_reasons = 0
+results = []
+
+# re-emit folders finished by a previous run which have since been moved out of the source
+if checkpoint:
+	for record in checkpoint.get_departed(folders):
+		total_failure_reasons += len(record["failure_reasons"])
+		results.append({"folder": record["name"], "failure_reasons": record["failure_reasons"]})
+		last_failed = print_result(record["name"], record["failure_reasons"], last_failed, "checkpointed")
 
 for curr in folders:
 
@@ -90,33 +384,79 @@ for curr in folders:
 	if not os.path.isdir(full_path):
 		continue
 
+	if checkpoint and checkpoint.is_done(curr):
+		record = checkpoint.records[curr]
+		total_failure_reasons += len(record["failure_reasons"])
+		results.append({"folder": record["name"], "failure_reasons": record["failure_reasons"]})
+		last_failed = print_result(record["name"], record["failure_reasons"], last_failed, "checkpointed")
+		if telemetry:
+			telemetry.skip_folder()
+		continue
+
+	if tree_cache:
+		record = tree_cache.get_verdict(curr)
+		if record:
+			total_failure_reasons += len(record["failure_reasons"])
+			results.append({"folder": curr, "failure_reasons": record["failure_reasons"]})
+			last_failed = print_result(curr, record["failure_reasons"], last_failed, "unchanged")
+			if checkpoint:
+				checkpoint.add(curr, curr, record["failure_reasons"])
+			if telemetry:
+				telemetry.skip_folder()
+			continue
+
 	blender.open_folder(full_path)
 
 	failure_reasons = blender.validate_folder()
 	total_failure_reasons += len(failure_reasons)
+	results.append({"folder": curr, "failure_reasons": failure_reasons})
 
-	if len(failure_reasons) is not 0:
+	last_failed = print_result(curr, failure_reasons, last_failed)
 
-		if last_failed is False:
-			print("-----------------------------------")
-		print("{0} {1}".format(string_colour("[FAIL]", Fore.RED), curr))
+	if telemetry:
+		telemetry.report()
 
-		for reason in failure_reasons:
-			print(string_background(reason, Back.RED))
-		print("-----------------------------------")
+	# the folder may have been renamed in place by --fix-foldernames
+	folder = curr
+	if blender.renamed_folder and os.path.dirname(os.path.abspath(blender.renamed_folder)) == os.path.abspath(source):
+		folder = os.path.basename(blender.renamed_folder)
+
+	if checkpoint:
+		checkpoint.add(folder, curr, failure_reasons)
+
+	# key the verdict on the folder as it now stands, never on the name it was given
+	# verdicts which depend on more than the folder itself (e.g. a destination collision) are never reused
+	if tree_cache:
+		if folder != curr:
+			tree_cache.forget(curr)
+		if blender.environment_errors:
+			tree_cache.forget(folder)
+		else:
+			tree_cache.update(folder, failure_reasons, blender.check_failures)
+
+
+if telemetry:
+	telemetry.report(True)
+	telemetry.clear()
+	if telemetry.errors:
+		print("Tag errors by check: {0}".format(", ".join("{0}: {1}".format(i, telemetry.errors[i]) for i in sorted(telemetry.errors))))
 
-		last_failed = True
+if args.io_order:
+	print("I/O ordering: {0}".format(mblib.format_seek_stats(blender.io_stats)))
 
+blender.remove_staging_root()
 
-	else:
-		print("{0} {1}".format(string_colour("[PASS]", Fore.GREEN), curr))
-		last_failed = False
+if tree_cache:
+	if not shard:
+		tree_cache.prune()
+	tree_cache.save()
 
+if args.shard_output:
+	shard_index, shard_count = shard or (0, 1)
+	mblib.write_shard_result(args.shard_output, source, shard_index, shard_count, results, started)
 
 print("Total tag errors: {0}".format(total_failure_reasons))
 
 
-# subfolder CD1/2
-# tracknumber check on multi CD
 # implement musicCRC?
 # 8 bit people
\ No newline at end of file
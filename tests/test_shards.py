@@ -0,0 +1,114 @@
+# runs n shard processes against one temporary library, then checks the merged result
+# matches an unsharded run of the same library
+#
+#   python -m unittest discover tests
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+import taglib
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "music-blender.py")
+
+# 128kbps CBR MPEG-1 layer III frame
+frame = b"\xff\xfb\x90\x64" + bytes(413)
+
+def make_album(root, name, artist, album, year, tracks, broken=False):
+	folder = os.path.join(root, name)
+	os.makedirs(folder)
+
+	for i in range(1, tracks + 1):
+		path = os.path.join(folder, "{0:02d} - Song {0}.mp3".format(i))
+		with open(path, "wb") as f:
+			f.write(frame * 200)
+
+		tags = {"ARTIST": artist, "ALBUMARTIST": artist, "ALBUM": album, "TITLE": "Song {0}".format(i),
+				"TRACKNUMBER": "{0}/{1}".format(i, tracks), "DISCNUMBER": "1/1"}
+		# one track missing its year, so the album fails validation
+		if not (broken and i == 2):
+			tags["DATE"] = year
+
+		track = taglib.File(path)
+		for tag in tags:
+			track.tags[tag] = [tags[tag]]
+		track.save()
+		track.close()
+
+class ShardTest(unittest.TestCase):
+	shards = 4
+
+	def setUp(self):
+		self.temp = tempfile.mkdtemp()
+		self.library = os.path.join(self.temp, "library")
+		os.makedirs(self.library)
+
+		for i in range(12):
+			artist = "Artist {0}".format(i)
+			album = "Album {0}".format(i)
+			# a mix of passing albums, misnamed albums and albums with bad tags
+			if i % 3 == 0:
+				name = "{0} - 2000 - {1} [CBR128]".format(artist, album)
+			else:
+				name = "folder {0}".format(i)
+			make_album(self.library, name, artist, album, "2000", 2 + i % 3, broken=i % 4 == 1)
+
+	def tearDown(self):
+		shutil.rmtree(self.temp)
+
+	def run_blender(self, *args):
+		return subprocess.Popen([sys.executable, script] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+	def test_merged_shards_match_unsharded_run(self):
+		whole = os.path.join(self.temp, "whole.json")
+		process = self.run_blender(self.library, "--no-progress", "--shard-output", whole)
+		process.communicate()
+
+		# every shard at once, as on separate machines
+		outputs = [os.path.join(self.temp, "shard{0}.json".format(i)) for i in range(self.shards)]
+		processes = [self.run_blender(self.library, "--no-progress", "--shard", "{0}/{1}".format(i, self.shards), "--shard-output", outputs[i])
+				for i in range(self.shards)]
+		for process in processes:
+			process.communicate()
+			self.assertEqual(process.returncode, 0)
+
+		merged_path = os.path.join(self.temp, "merged.json")
+		merge = self.run_blender("merge", "--output", merged_path, *outputs)
+		merge.communicate()
+		self.assertEqual(merge.returncode, 0)
+
+		with open(whole, encoding="utf-8") as f:
+			whole = json.load(f)
+		with open(merged_path, encoding="utf-8") as f:
+			merged = json.load(f)
+
+		self.assertEqual(merged["problems"], [])
+		self.assertEqual(merged["total_failure_reasons"], whole["total_failure_reasons"])
+		self.assertGreater(whole["total_failure_reasons"], 0)
+
+		folders = [i["folder"] for i in merged["folders"]]
+		self.assertEqual(len(folders), len(set(folders)))
+		self.assertEqual(sorted(folders), sorted(i["folder"] for i in whole["folders"]))
+		self.assertEqual(len(folders), 12)
+
+	def test_merge_reports_missing_and_duplicate_shards(self):
+		outputs = [os.path.join(self.temp, "shard{0}.json".format(i)) for i in range(2)]
+		for i in range(2):
+			self.run_blender(self.library, "--no-progress", "--shard", "{0}/3".format(i), "--shard-output", outputs[i]).communicate()
+
+		merged_path = os.path.join(self.temp, "merged.json")
+		merge = self.run_blender("merge", "--output", merged_path, outputs[0], outputs[1], outputs[1])
+		merge.communicate()
+		self.assertEqual(merge.returncode, 1)
+
+		with open(merged_path, encoding="utf-8") as f:
+			problems = json.load(f)["problems"]
+		self.assertIn("Missing shard 2/3", problems)
+		self.assertTrue(any(i.startswith("Duplicate shard 1/3") for i in problems))
+
+if __name__ == "__main__":
+	unittest.main()